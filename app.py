@@ -1,73 +1,237 @@
 import logging
-import music_tag
 import os
+import re
 
-from ext import setup_logger, config, args
+from collections import Counter
+from concurrent.futures import Executor, ThreadPoolExecutor
+from itertools import groupby
+from threading import BoundedSemaphore, Lock
+from time import sleep
+from typing import Iterable
+
+from cache import LyricsCache
+from ext import SCRIPT_DIR, load_config, parse_args, setup_logger
+from index import LibraryIndex
+from journal import Journal
 from linux_colors import cprint, Colors
-from lrc import NoTokenException
-from mutagen import MutagenError
-from song import Song
+from pipeline import bounded_map, lookahead, wait_for_winner
+from lrc import NoTokenException, ProviderException, ProviderUnavailableException, RateLimitedException
+from metrics import metrics
+from song import Song, try_read_tags
+from stats import ProviderStats
+from tokens import TokenBroker
+from watch import InotifyWatcher, PollingWatcher, inotify_available
+from workqueue import Heartbeat, WorkQueue, worker_id
+from writer import LyricsWriter
 
-from providers.lrclib import Lrclib
-from providers.musixmatch import Musixmatch
-from providers.spotify import Spotify
+from providers import PROVIDERS, provider_class
 
-CLIENT_ID = config.get('KEYS', 'CLIENT_ID')
-CLIENT_SECRET = config.get('KEYS', 'CLIENT_SECRET')
-SP_DC = config.get('KEYS', 'SP_DC')
+logger = logging.getLogger(__name__)
 
-setup_logger()
+prov_names = list(PROVIDERS)
 
-logger = logging.getLogger(__name__)
+# Seconds between two attempts of a worker to lease songs while the others hold the last ones
+WORK_QUEUE_POLL = 5
 
-prov_names = ['lrclib', 'spotify', 'musixmatch']
+AUDIO_EXTENSIONS = ('mp3', 'flac', 'm4a')
 
-def songs_from_dir(directory: str):
-    songs = []
-    for file in os.listdir(directory):
-        filepath = os.path.join(directory, file)
-        if os.path.isdir(filepath):
-            songs.extend(songs_from_dir(filepath))
-        elif os.path.isfile(filepath) and file.endswith(('mp3', 'flac', 'm4a')):
-            songs.append(Song(filepath=filepath))
-    return songs
+# Timestamp at the start of a line of synced lyrics, e.g. [01:23.45]
+TIMESTAMP = re.compile(r'^\[\d+:\d{2}(?:[.:]\d+)?\]\s*')
+
+# Arguments and configuration of the run, set by main
+args = None
+config = None
+
+providers = {}
+# Configured requests per second of each provider, before they are split between workers
+provider_rates = {}
+provider_slots = {}
+library_index = None
+race_pool = None
+writer = None
+journal = None
+work_queue = None
+provider_stats = None
+# Number of songs left out because the journal of a previous run already went through them
+resumed = 0
+# Size and modification time of the files the writer embedded lyrics in, by path, so that
+# watch mode does not take its own writes for new music
+written = {}
+# Number of songs for which each provider was skipped because its circuit was open
+skipped = Counter()
+skipped_lock = Lock()
+
+# Options shared by all the providers, the ones missing from the config are left
+# to the defaults of the getters
+def provider_options():
+    return {
+        'connect_timeout': config.getfloat('HTTP', 'CONNECT_TIMEOUT', fallback=None),
+        'read_timeout': config.getfloat('HTTP', 'READ_TIMEOUT', fallback=None),
+        'retries': config.getint('HTTP', 'RETRIES', fallback=None),
+        'backoff': config.getfloat('HTTP', 'BACKOFF', fallback=None),
+        'pool_size': args.provider_jobs,
+        'breaker_threshold': config.getint('BREAKER', 'THRESHOLD', fallback=None),
+        'breaker_cooldown': config.getfloat('BREAKER', 'COOLDOWN', fallback=None)
+    }
+
+def open_cache():
+    ttls = {
+        kind: config.getint('CACHE', f"{kind.upper()}_TTL", fallback=ttl // 3600) * 3600
+        for kind, ttl in LyricsCache.TTLS.items()
+    }
+    max_size = config.getint('CACHE', 'MAX_SIZE_MB', fallback=LyricsCache.MAX_SIZE // 1024 ** 2) * 1024 ** 2
+    return LyricsCache(config.get('CACHE', 'PATH', fallback='cache.db'), ttls, max_size)
+
+# Imports and builds the provider, only the ones in the order are ever built
+def build_provider(name: str, options: dict):
+    cls = provider_class(name)
+    options = {**options, 'rate': provider_rate(cls), 'endpoints': provider_endpoints(cls)}
+    token_dir = config.get('TOKENS', 'PATH', fallback='tokens')
+
+    if name == 'spotify':
+        return cls(config.get('KEYS', 'CLIENT_ID'), config.get('KEYS', 'CLIENT_SECRET'), config.get('KEYS', 'SP_DC'),
+                   token_dir, **options)
+    if name == 'musixmatch':
+        return cls(token_dir, **options)
+    if name == 'lrclib-dump':
+        lrclib_db = args.lrclib_db or config.get('LRCLIB_DUMP', 'PATH', fallback=None)
+        if not lrclib_db:
+            raise ValueError('Provider lrclib-dump requires the path of an LRCLIB database dump (--lrclib-db)')
+        return cls(lrclib_db, **options)
+    return cls(**options)
+
+# Maximum requests per second sent to the provider, 0 in the config disables the limit
+def provider_rate(cls):
+    return config.getfloat('RATES', cls.NAME.upper(), fallback=cls.RATE)
+
+# Endpoints overridden in the [ENDPOINTS:<provider>] section of the config, by class attribute name
+def provider_endpoints(cls):
+    section = f"ENDPOINTS:{cls.NAME}"
+    if not config.has_section(section):
+        return {}
+    return {name.upper(): url for name, url in config.items(section)}
 
-def songs_from_m3u(filepath: str):
-    songs = []
+# Builds the song for the file, serving it from the library index when the file did not change
+# since the last scan, otherwise parsing its tags (on parse_pool when one is given)
+def load_song(filepath: str, parse_pool: Executor = None):
+    try:
+        stat = os.stat(filepath)
+    except OSError as e:
+        logger.error(f"Skipping {filepath}: {e}")
+        record_file(filepath, 'unreadable', reason=str(e))
+        return None
+
+    record = library_index.get(filepath, stat) if library_index else None
+    if record:
+        metrics.count('songs_loaded', source='index')
+    else:
+        with metrics.timer('stage', stage='parse'):
+            if parse_pool:
+                record, error = parse_pool.submit(try_read_tags, filepath).result()
+            else:
+                record, error = try_read_tags(filepath, keep_tags=True)
+        if error:
+            logger.error(f"Skipping {filepath}: {error}")
+            metrics.count('songs_loaded', source='error')
+            record_file(filepath, 'unreadable', reason=error)
+            return None
+        metrics.count('songs_loaded', source='parse')
+        if library_index:
+            library_index.put(filepath, stat, record)
+
+    return Song.from_record(record)
+
+# Lazily turns the files into songs, parsing up to --scan-jobs files at a time
+def load_songs(filepaths: Iterable):
+    if args.scan_jobs <= 1:
+        for filepath in filepaths:
+            song = load_song(filepath)
+            if song:
+                yield song
+        return
+
+    parse_pool = None
+    if not args.scan_threads:
+        # Only imported when needed, it takes longer to import than the rest of the module
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # Forking now would copy the locks held by the writer, heartbeat and metrics threads,
+        # which can deadlock the workers, forkserver (spawn where it is missing) starts them clean
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        parse_pool = ProcessPoolExecutor(max_workers=args.scan_jobs, mp_context=multiprocessing.get_context(method))
+    try:
+        with ThreadPoolExecutor(max_workers=args.scan_jobs) as pool:
+            for song in bounded_map(lambda f: load_song(f, parse_pool), filepaths, pool, args.scan_jobs * 4):
+                if song:
+                    yield song
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+
+def files_from_dir(directory: str):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                yield from files_from_dir(entry.path)
+            elif entry.is_file() and entry.name.endswith(AUDIO_EXTENSIONS):
+                yield entry.path
+
+def files_from_m3u(filepath: str):
     with open(filepath, 'r') as f:
         for line in f:
             if not line.startswith('#'):
-                try:
-                    songs.append(Song(filepath=line.strip('\n')))
-                except MutagenError as e:
-                    logging.exception(e)
-    return songs
+                yield line.strip('\n')
 
-def save_lyrics(song: Song, lyrics: str, dump=args.dump):
-    lyrics = f"[00:00.00] {song.title}\n{lyrics}"
-    if dump:
-        return dump_lyrics(song, lyrics)
-    return edit_song_lyrics(song, lyrics)
+# Leaves out the files that the journal of a previous run already went through, before their
+# tags are parsed: with --resume every song that was done, with --retry-errors every song
+# but the ones that could not be read or whose lookup or write failed
+# A file leased from the work queue is completed with its outcome in the journal, otherwise
+# it would stay leased and keep the workers waiting for it
+def files_to_resume(filepaths: Iterable, outcomes: dict):
+    global resumed
+    for filepath in filepaths:
+        outcome = outcomes.get(os.path.abspath(filepath))
+        if args.retry_errors and outcome not in Journal.ERRORS or args.resume and outcome in Journal.DONE:
+            resumed += 1
+            if work_queue:
+                work_queue.complete(os.path.abspath(filepath), outcome or 'skipped')
+            continue
+        yield filepath
 
-def dump_lyrics(song: Song, lyrics: str):
-    filename = os.path.splitext(song.filepath)[0] + '.lrc'
-    try:
-        with open(filename, 'w') as f:
-            f.write(lyrics)
-    except Exception as e:
-        #logging.exception(e)
-        return False
-    return True
+# Called by the writer once the lyrics are embedded, so that the next scan
+# does not parse the file again just because its modification time changed
+def mark_saved(song: Song):
+    if args.watch:
+        stat = os.stat(song.filepath)
+        written[song.filepath] = (stat.st_size, stat.st_mtime_ns)
+    if library_index:
+        library_index.mark_lyrics(song.filepath)
 
-def edit_song_lyrics(song: Song, lyrics: str):
+def written_by_us(filepath: str):
     try:
-        song_file = music_tag.load_file(song.filepath)
-        song_file['lyrics'] = lyrics
-        song_file.save()
-    except Exception as e:
-        #logging.exception(e)
+        stat = os.stat(filepath)
+    except OSError:
         return False
-    return True
+    return written.pop(filepath, None) == (stat.st_size, stat.st_mtime_ns)
+
+# Leases the songs of the work queue a few at a time until the queue is empty, waiting
+# for the leases of the other workers to either complete or expire
+def leased_files(worker: str, count: int):
+    while True:
+        filepaths = work_queue.lease(worker, count)
+        if filepaths:
+            yield from filepaths
+        elif work_queue.remaining() == 0:
+            return
+        else:
+            sleep(WORK_QUEUE_POLL)
+
+# Splits the rate budget of each provider evenly between the active workers
+def split_rates(workers: int):
+    for prov, provider in providers.items():
+        if provider.limiter:
+            provider.limiter.set_max_rate(provider_rates[prov] / workers)
+    logger.debug(f"{workers} active workers sharing the rate budget")
 
 def disambiguate_order(order: str):
     found = []
@@ -76,6 +240,8 @@ def disambiguate_order(order: str):
         if prov in found:
             raise ValueError(f"Provider {prov} is duplicated")
         match = [name for name in prov_names if name.startswith(prov)]
+        # "lr" means lrclib rather than lrclib-dump, whose name extends it
+        match = [name for name in match if not any(name.startswith(m) and name != m for m in match)]
         if len(match) == 1:
             order[i] = match[0]
             found.append(match[0])
@@ -87,53 +253,403 @@ def disambiguate_order(order: str):
         
     return order
 
-if __name__ == '__main__':
-    songs = []
-    providers = {}
+# Only the lookups that reached the provider count in the statistics of --adaptive, the ones
+# answered by the cache would be counted again on every run, and the ones that failed are left
+# to the circuit breaker
+def lookup(prov: str, song: Song):
+    on_fetched = None
+    if provider_stats:
+        on_fetched = lambda lyrics, seconds: provider_stats.record(prov, song, bool(lyrics), seconds)
+    with provider_slots[prov]:
+        return providers[prov].lookup(song, args.type, on_fetched)
+
+# Waits for the lookup, logging its outcome, returns None when the provider failed
+def report(prov: str, song: Song, fetch, log):
+    try:
+        lyrics = fetch()
+    except NoTokenException as e:
+        log(f"{prov.capitalize()} {e}", Colors.RED)
+        return record_lookup(prov, song, 'no_token')
+    except ProviderUnavailableException as e:
+        log(f"{prov.capitalize()} {e}", Colors.YELLOW)
+        with skipped_lock:
+            skipped[prov] += 1
+        return record_lookup(prov, song, 'unavailable')
+    except RateLimitedException as e:
+        log(f"{prov.capitalize()} {e}, falling back to next provider", Colors.YELLOW)
+        return record_lookup(prov, song, 'rate_limited')
+    except ProviderException as e:
+        log(f"{prov.capitalize()} {e}, falling back to next provider", Colors.RED)
+        return record_lookup(prov, song, 'error')
+    if not lyrics:
+        log('Lyrics not found, falling back to next provider', Colors.YELLOW)
+    return record_lookup(prov, song, 'hit' if lyrics else 'miss', lyrics)
+
+def record_lookup(prov: str, song: Song, outcome: str, lyrics: str = None):
+    metrics.count('lookups', provider=prov, outcome=outcome)
+    song.outcomes[prov] = outcome
+    return lyrics
+
+def record_song(song: Song, outcome: str, reason: str = None):
+    record_file(song.filepath, outcome, song.outcomes, reason)
+
+# Appends the outcome of the file to the journal of the run and completes its job in the
+# work queue, if there are any
+def record_file(filepath: str, outcome: str, providers: dict = None, reason: str = None):
+    filepath = os.path.abspath(filepath)
+    if journal:
+        journal.record(filepath, outcome, providers, reason)
+    if work_queue:
+        work_queue.complete(filepath, outcome)
+
+# Queries the providers one after the other, yielding (provider, lyrics) for every hit
+def serial_lookups(song: Song, order: list, log):
+    for prov in order:
+        log(f"Fetching lyrics from {prov}", Colors.BLUE)
+        lyrics = report(prov, song, lambda: lookup(prov, song), log)
+        if lyrics:
+            yield prov, lyrics
+
+# Queries the providers concurrently, each one --hedge-delay seconds after the previous one
+# unless a winner is already certain, but still yields the hits in priority order
+# Lookups that can no longer win are cancelled (or ignored if already running) once the
+# caller stops consuming, the providers never started are queried serially if all the others fail
+def race_lookups(song: Song, order: list, log):
+    futures = []
+    try:
+        for prov in order:
+            if futures and wait_for_winner(futures, args.hedge_delay):
+                break
+            futures.append(race_pool.submit(lookup, prov, song))
+
+        for prov, future in zip(order, futures):
+            log(f"Fetching lyrics from {prov}", Colors.BLUE)
+            lyrics = report(prov, song, future.result, log)
+            if lyrics:
+                yield prov, lyrics
+    finally:
+        for future in futures:
+            future.cancel()
+
+    yield from serial_lookups(song, order[len(futures):], log)
+
+# Queries the providers in the order (adapted to the song with --adaptive),
+# returns the first (provider, lyrics) found, (None, None) when no provider had them
+def find_lyrics(song: Song, order: list, log=cprint):
+    if provider_stats:
+        order = provider_stats.order(song, order)
+    lookups = race_lookups(song, order, log) if args.strategy == 'race' else serial_lookups(song, order, log)
+    try:
+        with metrics.timer('stage', stage='lookup'):
+            return next(lookups, (None, None))
+    finally:
+        lookups.close()
+
+# Hands the first lyrics found to the writer, returns the future of the write
+# or None when the song was skipped or no provider had its lyrics
+def process_song(song: Song, order: list, log=cprint, force=False):
+    if song.has_lyrics and not args.overwrite and not force:
+        log('Lyrics already present, skipping', Colors.END)
+        metrics.count('songs', outcome='skipped')
+        record_song(song, 'skipped')
+        return None
+
+    _, lyrics = find_lyrics(song, order, log)
+    return save_lyrics(song, lyrics)
+
+# Returns the future of the write, or None when there are no lyrics to write
+def save_lyrics(song: Song, lyrics: str):
+    if not lyrics:
+        metrics.count('songs', outcome='not_found')
+        # A failed provider might still have the lyrics, --retry-errors looks the song up again
+        failed = any(outcome not in ('hit', 'miss') for outcome in song.outcomes.values())
+        record_song(song, 'error' if failed else 'not_found')
+        return None
+    metrics.count('songs', outcome='found')
 
-    L = Lrclib()
-    S = Spotify(CLIENT_ID, CLIENT_SECRET, SP_DC, 'tokens')
-    M = Musixmatch('tokens')
+    write = writer.submit(song, lyrics)
+    write.add_done_callback(lambda w: record_song(song, 'saved' if w.result()[0] else 'failed', w.result()[1]))
+    return write
 
-    providers['lrclib'] = L
-    providers['spotify'] = S
-    providers['musixmatch'] = M
+# Runs process_song on a worker thread, buffering its output
+# so that the main thread can print it in the original song order
+def process_song_buffered(song: Song, order: list):
+    lines = []
+    write = process_song(song, order, lambda text, color: lines.append((text, color)))
+    return write, lines
+
+def find_lyrics_buffered(song: Song, order: list):
+    lines = []
+    found = find_lyrics(song, order, lambda text, color: lines.append((text, color)))
+    return found, lines
+
+# Describes the prefetched lookup of the song at the prompt of interactive mode
+def lookup_status(song: Song, lookup):
+    if not lookup.done():
+        return 'Still looking for lyrics, they are saved as soon as they are found', Colors.BLUE
+    if lookup.exception():
+        return f"Lookup failed: {lookup.exception()}", Colors.RED
+
+    (prov, lyrics), _ = lookup.result()
+    if not lyrics:
+        outcomes = ', '.join(f"{p}: {outcome}" for p, outcome in song.outcomes.items())
+        return f"No lyrics found ({outcomes})", Colors.YELLOW
+
+    lines = [line for line in lyrics.splitlines() if line.strip()]
+    synced = any(TIMESTAMP.match(line) for line in lines)
+    preview = next((TIMESTAMP.sub('', line) for line in lines if TIMESTAMP.sub('', line).strip()), '')
+    return f"Found on {prov}, {'synced' if synced else 'plain'}, {len(lines)} lines: {preview}", Colors.GREEN
+
+# Waits for the lyrics of the song to be written, returns whether they were saved
+def report_write(song: Song, write, log=cprint):
+    if write is None:
+        return False
+    saved, reason = write.result()
+    if saved:
+        log(f"Lyrics {'overridden' if song.has_lyrics else 'saved'}", Colors.GREEN)
+    else:
+        log(f"Failed to save lyrics: {reason}", Colors.RED)
+    return saved
+
+# Resolves the track ids of a whole album at once with every provider in the order that supports it,
+# when that fails the songs are simply searched one by one
+def resolve_album(songs: list, order: list):
+    if len(songs) < 2 or (all(song.has_lyrics for song in songs) and not args.overwrite):
+        return songs
+    for prov in order:
+        try:
+            with provider_slots[prov]:
+                providers[prov].resolve_album(songs)
+        except (NoTokenException, ProviderException) as e:
+            logger.warning(f"{prov.capitalize()} failed to resolve album {songs[0].album}: {e}")
+    return songs
+
+# Groups consecutive songs of the same album, which a directory walk yields together,
+# and resolves each album on its own worker
+def resolve_albums(songs: Iterable, order: list, jobs: int):
+    albums = (list(album) for _, album in groupby(songs, key=Song.album_key))
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for album in bounded_map(lambda a: resolve_album(a, order), albums, pool, jobs * 2):
+            yield from album
+
+# Consumes the songs lazily, so the total is only known once they are all processed
+# Outside of interactive mode the songs are looked up on a pool of workers while the main
+# thread prints their output in order and waits for their writes, so that a slow write
+# never holds up the lookups of the songs that follow
+def process_songs(songs: Iterable, order: list, jobs: int):
+    lyrics_saved = 0
+    total = 0
+
+    if not args.interactive:
+        jobs = max(jobs, 1)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = bounded_map(lambda s: (s, process_song_buffered(s, order)), songs, pool, jobs * 2)
+            for song, (write, lines) in results:
+                total += 1
+                cprint(f"\nProcessing song {total}", Colors.CYAN)
+                print(song)
+                for text, color in lines:
+                    cprint(text, color)
+                lyrics_saved += report_write(song, write)
+        return lyrics_saved, total
+
+    # The lyrics of the next --prefetch songs are looked up while the user answers about the current
+    # one, so that saving them does not wait on the network, the lookups of skipped songs
+    # are discarded (the lookup cache still keeps them)
+    ahead = max(args.prefetch, 0)
+    with ThreadPoolExecutor(max_workers=ahead + 1) as pool:
+        lookups = lookahead(lambda s: find_lyrics_buffered(s, order), songs, pool, ahead)
+        try:
+            for song, lookup in lookups:
+                total += 1
+                cprint(f"\nProcessing song {total}", Colors.CYAN)
+                print(song)
+                logger.info(song)
+                cprint(*lookup_status(song, lookup))
+                if input(f"Continue? {'(Lyrics found)' if song.has_lyrics else ''} [y/N]: ").lower() != 'y':
+                    print('Skipping song')
+                    metrics.count('songs', outcome='skipped')
+                    record_song(song, 'skipped')
+                    continue
+
+                # find_lyrics reports the failures of the providers, anything else
+                # is a bug that should not end the whole session
+                if lookup.exception():
+                    cprint(f"Lookup failed: {lookup.exception()}", Colors.RED)
+                    metrics.count('songs', outcome='error')
+                    record_song(song, 'error', str(lookup.exception()))
+                    continue
+
+                (_, lyrics), lines = lookup.result()
+                for text, color in lines:
+                    cprint(text, color)
+                lyrics_saved += report_write(song, save_lyrics(song, lyrics))
+        finally:
+            # Cancels the lookups of the songs not reached yet when the user interrupts the run
+            lookups.close()
+    return lyrics_saved, total
+
+def create_watcher(directory: str):
+    if args.poll or not inotify_available():
+        if not args.poll:
+            logger.warning('inotify is not available, polling the library instead')
+        return PollingWatcher(directory, AUDIO_EXTENSIONS, args.poll, args.debounce)
+    return InotifyWatcher(directory, AUDIO_EXTENSIONS, args.debounce)
+
+# Looks up the songs added or modified under the directory as they appear, until interrupted,
+# with the providers, their sessions and their tokens kept from the previous songs
+def watch_library(watcher, order: list, jobs: int):
+    lyrics_saved = 0
+    total = 0
+    try:
+        for filepaths in watcher:
+            filepaths = [f for f in filepaths if not written_by_us(f)]
+            if not filepaths:
+                continue
+            songs = load_songs(filepaths)
+            if args.albums:
+                songs = resolve_albums(songs, order, jobs)
+            saved, count = process_songs(songs, order, jobs)
+            cprint(f"{saved} lyrics saved out of {count} new songs", Colors.GREEN)
+            lyrics_saved += saved
+            total += count
+            if library_index:
+                library_index.commit()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        watcher.close()
+    return lyrics_saved, total
+
+# Runs the command line with the given arguments (sys.argv when None) and returns the number
+# of lyrics saved and of songs processed, importing the module has no side effects so
+# other programs can call it as well
+def main(argv: list = None):
+    global args, config, library_index, race_pool, writer, journal, work_queue, provider_stats, resumed
+
+    args = parse_args(argv)
+    config = load_config(args.config)
+    # Programs that configured their own logging keep it
+    if not logging.getLogger().handlers:
+        setup_logger(args.verbose)
+
+    for state in (providers, provider_rates, provider_slots, written, skipped):
+        state.clear()
+    library_index = race_pool = writer = journal = work_queue = provider_stats = None
+    resumed = 0
+    metrics.reset()
+
+    if args.enqueue:
+        work_queue = WorkQueue(args.enqueue)
+        if os.path.isfile(args.filepath) and args.filepath.endswith(('m3u', 'm3u8')):
+            queued = work_queue.enqueue(files_from_m3u(args.filepath))
+        else:
+            queued = work_queue.enqueue(files_from_dir(args.filepath))
+        cprint(f"{queued} songs queued, {work_queue.remaining()} waiting for workers in {args.enqueue}", Colors.GREEN)
+        work_queue.close()
+        work_queue = None
+        return 0, 0
 
     order = disambiguate_order(args.order)
 
-    if os.path.isfile(args.filepath):
+    if not args.no_index:
+        library_index = LibraryIndex(config.get('INDEX', 'PATH', fallback='index.db'))
+
+    options = provider_options()
+    if not args.no_cache:
+        options['cache'] = open_cache()
+    options['tokens'] = TokenBroker(config.get('TOKENS', 'PATH', fallback='tokens'))
+
+    for prov in order:
+        providers[prov] = build_provider(prov, options)
+        provider_slots[prov] = BoundedSemaphore(args.provider_jobs)
+
+    if args.adaptive:
+        provider_stats = ProviderStats(config.get('STATS', 'PATH', fallback='stats.db'),
+                                       config.getfloat('STATS', 'EXPLORE', fallback=None))
+
+    if args.strategy == 'race':
+        race_pool = ThreadPoolExecutor(max_workers=max(args.jobs, 1) * len(order))
+
+    writer = LyricsWriter(args.write_jobs, args.dump, mark_saved)
+
+    if args.metrics or args.prom:
+        metrics.enable()
+        if args.metrics_interval > 0:
+            metrics.start_flushing(args.metrics_interval, args.metrics, args.prom)
+
+    for prov, provider in providers.items():
+        if provider.limiter:
+            provider_rates[prov] = provider.limiter.max_rate
+
+    if args.watch and not os.path.isdir(args.filepath):
+        raise ValueError('Watch mode requires the path of a directory')
+
+    watcher = None
+    heartbeat = None
+    if args.worker:
+        work_queue = WorkQueue(args.worker)
+        worker = worker_id()
+        heartbeat = Heartbeat(work_queue, worker, split_rates)
+        filepaths = leased_files(worker, max(args.jobs, 1) * 2)
+    elif os.path.isfile(args.filepath):
         if args.filepath.endswith(('m3u', 'm3u8')):
-            songs = songs_from_m3u(args.filepath)
+            filepaths = files_from_m3u(args.filepath)
         else:
-            songs.append(Song(filepath=args.filepath))
+            filepaths = [args.filepath]
     else:
-        songs = songs_from_dir(args.filepath)
+        if args.watch:
+            # Created before the first pass, so that the files added meanwhile are not missed
+            watcher = create_watcher(args.filepath)
+        filepaths = files_from_dir(args.filepath)
 
-    lyrics_saved = 0
-    for i, song in enumerate(songs):
-        cprint(f"\nProcessing song {i + 1} / {len(songs)}", Colors.CYAN)
-        print(song)
-        if args.interactive:
-            logger.info(song)
-            if input(f"Continue? {'(Lyrics found)' if song.has_lyrics else ''} [y/N]: ").lower() != 'y':
-                print('Skipping song')
-                continue
-        elif song.has_lyrics and not args.overwrite:
-            print('Lyrics already present, skipping')
-            continue
-        for prov in order:
-            try:
-                cprint(f"Fetching lyrics from {prov}", Colors.BLUE)
-                lyrics = providers[prov].get_lyrics(song, args.type)
-                if lyrics:
-                    if save_lyrics(song, lyrics):
-                        cprint(f"Lyrics {'overridden' if song.has_lyrics else 'saved'}", Colors.GREEN)
-                        lyrics_saved += 1
-                        break
-                    cprint('Failed to save lyrics', Colors.RED)
-                else:
-                    cprint('Lyrics not found, falling back to next provider', Colors.YELLOW)
-            except NoTokenException as e:
-                cprint(f"{prov.capitalize()} {e}", Colors.RED)
-    cprint(f"{lyrics_saved} lyrics saved out of {len(songs)} songs", Colors.GREEN)
+    if args.journal:
+        if args.resume or args.retry_errors:
+            filepaths = files_to_resume(filepaths, Journal.load(args.journal))
+        journal = Journal(args.journal)
+
+    songs = load_songs(filepaths)
 
+    if args.albums:
+        songs = resolve_albums(songs, order, args.jobs)
+
+    lyrics_saved, total = process_songs(songs, order, args.jobs)
+
+    if watcher:
+        cprint(f"{lyrics_saved} lyrics saved out of {total} songs, watching {args.filepath} for new music", Colors.GREEN)
+        if library_index:
+            library_index.commit()
+        saved, count = watch_library(watcher, order, args.jobs)
+        lyrics_saved += saved
+        total += count
+
+    writer.close()
+    if heartbeat:
+        heartbeat.stop()
+        counts = work_queue.counts()
+        work_queue.close()
+        cprint(f"Work queue: {counts.get('done', 0)} songs done, {counts.get('error', 0)} failed", Colors.CYAN)
+    if race_pool:
+        race_pool.shutdown(cancel_futures=True)
+    if library_index:
+        library_index.close()
+    if journal:
+        journal.close()
+    if provider_stats:
+        provider_stats.close()
+    if metrics.enabled:
+        metrics.stop()
+        metrics.flush(args.metrics, args.prom)
+    cprint(f"{lyrics_saved} lyrics saved out of {total} songs", Colors.GREEN)
+    if resumed:
+        cprint(f"{resumed} songs were left out, the journal already went through them", Colors.YELLOW)
+    for prov, count in skipped.items():
+        cprint(f"{prov.capitalize()} was skipped for {count} songs while unavailable", Colors.YELLOW)
+    if provider_stats and provider_stats.leaders:
+        leaders = ', '.join(f"{prov} for {count}" for prov, count in provider_stats.leaders.most_common())
+        cprint(f"Providers queried first: {leaders} songs", Colors.CYAN)
+    return lyrics_saved, total
+
+if __name__ == '__main__':
+    os.chdir(SCRIPT_DIR)
+    main()
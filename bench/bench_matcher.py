@@ -0,0 +1,59 @@
+import random
+import re
+import string
+
+from rapidfuzz import fuzz
+from timeit import timeit
+
+from providers.getter import Matcher
+from song import Song
+
+'''
+Microbenchmark of the result ranking used by the providers
+Compares the batched Matcher with the previous approach, which recompiled the splitter
+and normalized both strings for every candidate, then scored the winner a second time
+Run from the repository root with: python -m bench.bench_matcher
+'''
+
+def legacy_best(results: list, compare_fn, song: Song, min: int = 70):
+    def similarity(a, b):
+        splitter = re.compile(r'(?:feat.)|(?:ft.)|(?:with)|(?:\s[xX]\s(?!([Aa]mbassador)))|\s*[&,×+;\/·]\s*')
+        return fuzz.token_set_ratio(splitter.sub('', a.lower()), splitter.sub('', b.lower()))
+
+    song_str = f"{song.title} {song.artist} {song.album}"
+    best = sorted(results, key=lambda t: similarity(compare_fn(t), song_str), reverse=True)[0]
+    return best if round(similarity(song_str, compare_fn(best))) >= min else None
+
+def batched_best(results: list, compare_fn, song: Song, min: int = 70):
+    best, score = Matcher(song).best(results, compare_fn)
+    return best if round(score) >= min else None
+
+def words(n: int):
+    return ' '.join(''.join(random.choices(string.ascii_lowercase, k=random.randint(3, 9))) for _ in range(n))
+
+def candidates(song: Song, size: int):
+    results = [
+        {'name': words(3), 'artists': [{'name': words(2)}, {'name': words(1)}], 'album': {'name': words(2)}}
+        for _ in range(size - 1)
+    ]
+    results.insert(random.randrange(size), {
+        'name': song.title,
+        'artists': [{'name': song.artist}, {'name': 'Someone feat. Else'}],
+        'album': {'name': song.album}
+    })
+    return results
+
+if __name__ == '__main__':
+    random.seed(0)
+    song = Song('Midnight City', 'M83', "Hurry Up, We're Dreaming", 244)
+    compare = lambda t: f"{t['name']} {' '.join([a['name'] for a in t['artists']])} {t['album']['name']}"
+    runs = 2000
+
+    print(f"{'page size':>10} {'legacy (us)':>12} {'batched (us)':>13} {'speedup':>8}")
+    for size in (5, 20, 50, 200):
+        results = candidates(song, size)
+        assert legacy_best(results, compare, song) is batched_best(results, compare, song)
+
+        legacy = timeit(lambda: legacy_best(results, compare, song), number=runs) / runs * 1e6
+        batched = timeit(lambda: batched_best(results, compare, song), number=runs) / runs * 1e6
+        print(f"{size:>10} {legacy:>12.1f} {batched:>13.1f} {legacy / batched:>7.1f}x")
@@ -0,0 +1,186 @@
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from collections import Counter
+from configparser import ConfigParser
+from time import monotonic, time
+
+from bench.library import catalog, generate
+from bench.standin import StandIn
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+'''
+End to end benchmark of app.py against the local provider stand-in (bench/standin.py)
+Generates a synthetic library, runs the whole pipeline on it as a separate process with a
+throwaway cache, index, token folder and provider statistics, and reports songs/s, the p50 and p99 latency of
+the songs (from the first request about the song to its lyrics being written), the peak
+RSS of the process and the time spent in each stage according to the metrics of app.py,
+optionally comparing them with a baseline saved by a previous run
+The rate limits of the providers are lifted unless --keep-rates is given, so that the
+numbers reflect the pipeline rather than the configured rates
+Options not listed below are passed on to app.py
+Run from the repository root with: python -m bench.bench_pipeline --songs 500 -- -j 8
+'''
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+METRICS = ('songs_per_sec', 'p50_ms', 'p99_ms', 'peak_rss_mb', 'requests')
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def write_config(path: str, workdir: str, standin: StandIn, keep_rates: bool):
+    config = ConfigParser()
+    config.optionxform = str
+    config['KEYS'] = {'CLIENT_ID': 'standin', 'CLIENT_SECRET': 'standin', 'SP_DC': 'standin'}
+    config['CACHE'] = {'PATH': os.path.join(workdir, 'cache.db')}
+    config['INDEX'] = {'PATH': os.path.join(workdir, 'index.db')}
+    config['TOKENS'] = {'PATH': os.path.join(workdir, 'tokens')}
+    config['STATS'] = {'PATH': os.path.join(workdir, 'stats.db')}
+    if not keep_rates:
+        config['RATES'] = {'LRCLIB': '0', 'SPOTIFY': '0', 'MUSIXMATCH': '0'}
+    for provider, endpoints in standin.endpoints().items():
+        config[f"ENDPOINTS:{provider}"] = endpoints
+    with open(path, 'w') as f:
+        config.write(f)
+
+# The end of a song is when its file (or its .lrc) was last written, or its last response
+# when nothing was written
+def song_latencies(standin: StandIn, paths: list, started: float):
+    latencies = []
+    for n, (first, last) in standin.timings.items():
+        for path in (os.path.splitext(paths[n])[0] + '.lrc', paths[n]):
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime >= started:
+                last = max(last, mtime)
+            break
+        latencies.append((last - first) * 1000)
+    return latencies
+
+def run(options, app_args: list):
+    workdir = tempfile.mkdtemp(prefix='lrcgetter-bench-')
+    try:
+        tracks = catalog(options.songs, options.seed)
+        paths = generate(os.path.join(workdir, 'library'), tracks)
+
+        standin = StandIn(tracks, options.latency / 1000, options.jitter, options.error_rate,
+                          options.throttle_rate, options.retry_after, options.miss_rate, options.seed)
+        standin.start()
+        config_path = os.path.join(workdir, 'config.cfg')
+        write_config(config_path, workdir, standin, options.keep_rates)
+
+        metrics_path = os.path.join(workdir, 'metrics.json')
+        if '--metrics' not in app_args:
+            app_args = [*app_args, '--metrics', metrics_path]
+        else:
+            metrics_path = app_args[app_args.index('--metrics') + 1]
+
+        log_path = os.path.join(workdir, 'app.log')
+        started = time()
+        start = monotonic()
+        with open(log_path, 'w') as log:
+            process = subprocess.run([sys.executable, APP, os.path.join(workdir, 'library'), '-c', config_path, *app_args],
+                                     stdout=log, stderr=subprocess.STDOUT)
+        elapsed = monotonic() - start
+        standin.stop()
+
+        with open(log_path) as f:
+            output = f.read()
+        if process.returncode != 0:
+            sys.exit(f"app.py exited with {process.returncode}:\n{output[-2000:]}")
+
+        summary = re.search(r'(\d+) lyrics saved out of (\d+) songs', output)
+        saved, total = (int(summary.group(1)), int(summary.group(2))) if summary else (0, 0)
+        latencies = song_latencies(standin, paths, started)
+        with open(metrics_path) as f:
+            timers = json.load(f)['timers']
+        stages = {
+            '/'.join(filter(None, [t['stage'], t.get('provider'), t.get('token')])): {
+                'count': t['count'], 'total_s': t['total_s'], 'mean_ms': t['mean_ms']
+            }
+            for t in timers.get('stage', [])
+        }
+
+        statuses = Counter()
+        for (_, status), count in standin.requests.items():
+            statuses[str(status)] += count
+
+        return {
+            'songs': total,
+            'saved': saved,
+            'elapsed_s': round(elapsed, 3),
+            'songs_per_sec': round(total / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1) if resource else None,
+            'requests': sum(standin.requests.values()),
+            'statuses': dict(sorted(statuses.items())),
+            'stages': stages,
+            'endpoints': {f"{endpoint} {status}": count for (endpoint, status), count in sorted(standin.requests.items())}
+        }
+    finally:
+        if options.keep:
+            print(f"Kept the library, config and log in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def report(result: dict, baseline: dict = None):
+    print(f"{result['saved']} lyrics saved out of {result['songs']} songs in {result['elapsed_s']}s")
+    print(f"{'metric':>14} {'value':>10}" + (f" {'baseline':>10} {'change':>8}" if baseline else ''))
+    for metric in METRICS:
+        value = result[metric]
+        line = f"{metric:>14} {value if value is not None else 'n/a':>10}"
+        if baseline and baseline.get(metric) and value is not None:
+            line += f" {baseline[metric]:>10} {(value - baseline[metric]) / baseline[metric]:>+8.1%}"
+        print(line)
+    print(f"{'statuses':>14} {', '.join(f'{s}: {c}' for s, c in result['statuses'].items())}")
+
+    print(f"\n{'stage':>28} {'count':>7} {'total (s)':>10} {'mean (ms)':>10}")
+    for stage, timer in sorted(result['stages'].items(), key=lambda s: -s[1]['total_s']):
+        print(f"{stage:>28} {timer['count']:>7} {timer['total_s']:>10.3f} {timer['mean_ms']:>10.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark app.py against a local stand-in of the providers')
+    parser.add_argument('--songs', help='Size of the synthetic library', type=int, default=200)
+    parser.add_argument('--latency', help='Mean latency of the stand-in responses, in milliseconds', type=float, default=50)
+    parser.add_argument('--jitter', help='Spread of the latency, as a fraction of the mean', type=float, default=0.5)
+    parser.add_argument('--error-rate', help='Share of the requests answered with 500', type=float, default=0)
+    parser.add_argument('--throttle-rate', help='Share of the requests answered with 429', type=float, default=0)
+    parser.add_argument('--retry-after', help='Retry-After sent with the 429 responses, in seconds', type=float, default=1)
+    parser.add_argument('--miss-rate', help='Share of the songs missing from each provider', type=float, default=0.2)
+    parser.add_argument('--keep-rates', help='Keep the rate limits of the providers', action='store_true')
+    parser.add_argument('--seed', help='Seed of the library and of the stand-in faults', type=int, default=0)
+    parser.add_argument('--save', help='Save the results as JSON, to be used as a baseline later')
+    parser.add_argument('--baseline', help='Compare the results with the ones saved by --save')
+    parser.add_argument('--keep', help='Keep the library, the config and the output of app.py', action='store_true')
+    options, app_args = parser.parse_known_args()
+    app_args = [a for a in app_args if a != '--']
+
+    result = run(options, app_args)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(result, f, indent=4)
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from time import monotonic
+
+from bench.bench_pipeline import APP, write_config
+from bench.library import catalog, generate
+from bench.standin import StandIn
+
+'''
+Cold start benchmark of app.py: the time it takes a new process to look up and save the
+lyrics of a single file, against the local provider stand-in (bench/standin.py)
+Each run is a fresh interpreter, reported next to the time of a bare interpreter and of
+importing app.py alone, so that a regression in the imports shows up on its own
+Options not listed below are passed on to app.py (-o lrclib --no-cache -w by default)
+Run from the repository root with: python -m bench.bench_startup --runs 20
+'''
+
+ROOT = os.path.dirname(APP)
+DEFAULT_ARGS = ['-o', 'lrclib', '--no-cache', '-w']
+METRICS = ('interpreter_ms', 'import_ms', 'single_file_ms')
+
+def timed(command: list, cwd: str = None):
+    start = monotonic()
+    process = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    elapsed = (monotonic() - start) * 1000
+    if process.returncode != 0:
+        sys.exit(f"{' '.join(command)} exited with {process.returncode}:\n{process.stdout.decode()[-2000:]}")
+    return elapsed
+
+def run(options, app_args: list):
+    workdir = tempfile.mkdtemp(prefix='lrcgetter-startup-')
+    try:
+        tracks = catalog(1, options.seed)
+        # Every run finds the song, so that all of them take the same path
+        standin = StandIn(tracks, options.latency / 1000, 0, miss_rate=0, seed=options.seed)
+        standin.start()
+        config_path = os.path.join(workdir, 'config.cfg')
+        write_config(config_path, workdir, standin, keep_rates=False)
+        filepath = generate(os.path.join(workdir, 'library'), tracks)[0]
+
+        timings = {metric: [] for metric in METRICS}
+        for _ in range(options.runs):
+            timings['interpreter_ms'].append(timed([sys.executable, '-c', 'pass']))
+            timings['import_ms'].append(timed([sys.executable, '-c', 'import app'], cwd=ROOT))
+            timings['single_file_ms'].append(timed([sys.executable, APP, filepath, '-c', config_path, *app_args]))
+        standin.stop()
+
+        return {
+            'runs': options.runs,
+            **{metric: round(statistics.median(values), 1) for metric, values in timings.items()},
+            'min': {metric: round(min(values), 1) for metric, values in timings.items()},
+            'max': {metric: round(max(values), 1) for metric, values in timings.items()}
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def report(result: dict, baseline: dict = None):
+    print(f"Median of {result['runs']} runs, in milliseconds")
+    print(f"{'metric':>16} {'median':>8} {'min':>8} {'max':>8}" + (f" {'baseline':>9} {'change':>8}" if baseline else ''))
+    for metric in METRICS:
+        line = f"{metric:>16} {result[metric]:>8} {result['min'][metric]:>8} {result['max'][metric]:>8}"
+        if baseline and baseline.get(metric):
+            line += f" {baseline[metric]:>9} {(result[metric] - baseline[metric]) / baseline[metric]:>+8.1%}"
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of app.py on a single file')
+    parser.add_argument('--runs', help='Number of fresh processes to time', type=int, default=10)
+    parser.add_argument('--latency', help='Latency of the stand-in responses, in milliseconds', type=float, default=0)
+    parser.add_argument('--seed', help='Seed of the generated song', type=int, default=0)
+    parser.add_argument('--save', help='Save the results as JSON, to be used as a baseline later')
+    parser.add_argument('--baseline', help='Compare the results with the ones saved by --save')
+    options, app_args = parser.parse_known_args()
+    app_args = [a for a in app_args if a != '--'] or DEFAULT_ARGS
+
+    result = run(options, app_args)
+
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(result, f, indent=4)
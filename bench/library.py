@@ -0,0 +1,82 @@
+import music_tag
+import os
+import random
+import struct
+import sys
+
+'''
+Generator of the synthetic tagged library used by the benchmarks
+The audio files are tiny valid MP3s (a Xing header declaring the frame count) and FLACs
+(a bare STREAMINFO block), so that mutagen reports realistic durations for a few hundred
+bytes on disk, laid out as Artist/Album/NN.ext with ALBUMS_PER_ARTIST albums of
+TRACKS_PER_ALBUM songs each
+Run from the repository root with: python -m bench.library DIRECTORY SONGS
+'''
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 3
+FLAC_SHARE = 0.3
+
+# 128kbps 44.1kHz joint stereo MPEG-1 Layer III frame
+MP3_HEADER = b'\xff\xfb\x90\x64'
+MP3_FRAME_SIZE = 417
+MP3_SAMPLES_PER_FRAME = 1152
+SAMPLE_RATE = 44100
+
+def write_mp3(path: str, seconds: float):
+    frame = bytearray(MP3_HEADER + b'\x00' * (MP3_FRAME_SIZE - 4))
+    # The Xing tag sits right after the 32 bytes of side information of a stereo frame
+    frames = round(seconds * SAMPLE_RATE / MP3_SAMPLES_PER_FRAME)
+    frame[36:48] = b'Xing' + struct.pack('>II', 1, frames)
+    with open(path, 'wb') as f:
+        f.write(bytes(frame) + MP3_HEADER + b'\x00' * (MP3_FRAME_SIZE - 4))
+
+def write_flac(path: str, seconds: float):
+    # Sample rate (20 bits), channels - 1 (3 bits), bits per sample - 1 (5 bits), total samples (36 bits)
+    stream = (SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | round(seconds * SAMPLE_RATE)
+    info = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + stream.to_bytes(8, 'big') + b'\x00' * 16
+    with open(path, 'wb') as f:
+        f.write(b'fLaC' + bytes([0x80]) + len(info).to_bytes(3, 'big') + info)
+
+# Returns the tags of the songs of a library of the given size, the same seed always gives the same library
+def catalog(songs: int, seed: int = 0):
+    rng = random.Random(seed)
+    tracks = []
+    for n in range(songs):
+        album = n // TRACKS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+        tracks.append({
+            'n': n,
+            'title': f"Track {n:05d}",
+            'artist': f"Artist {artist:04d}",
+            'album': f"Album {album:05d}",
+            'albumartist': f"Artist {artist:04d}",
+            'tracknumber': n % TRACKS_PER_ALBUM + 1,
+            'duration': round(rng.uniform(120, 360), 2),
+            'isrc': f"ZZBEN{n:07d}",
+            'format': 'flac' if rng.random() < FLAC_SHARE else 'mp3'
+        })
+    return tracks
+
+# Writes the songs of the catalog under directory, returns the paths of the files
+def generate(directory: str, tracks: list):
+    paths = []
+    for track in tracks:
+        folder = os.path.join(directory, track['artist'], track['album'])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{track['tracknumber']:02d}.{track['format']}")
+
+        if track['format'] == 'flac':
+            write_flac(path, track['duration'])
+        else:
+            write_mp3(path, track['duration'])
+
+        audiofile = music_tag.load_file(path)
+        for tag in ('title', 'artist', 'album', 'albumartist', 'tracknumber', 'isrc'):
+            audiofile[tag] = track[tag]
+        audiofile.save()
+        paths.append(path)
+    return paths
+
+if __name__ == '__main__':
+    generate(sys.argv[1], catalog(int(sys.argv[2])))
@@ -0,0 +1,315 @@
+import json
+import random
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs, urlsplit
+
+'''
+Local stand-in for the Spotify, Musixmatch and LRCLIB endpoints used by the providers
+It answers with responses shaped like the ones recorded from the real APIs, built from the
+catalog of the synthetic library (see bench/library.py), after a configurable latency, and
+fails the given share of the requests with 500 or 429 Too Many Requests (token requests
+are never failed), while a share of the songs is missing from each provider
+Every request is attributed to the song it is about, so that the benchmark can tell
+when the lookups of each song started and ended
+'''
+
+class StandIn:
+
+    def __init__(self, tracks: list, latency: float = 0.05, jitter: float = 0.5, error_rate: float = 0,
+                 throttle_rate: float = 0, retry_after: float = 1, miss_rate: float = 0, seed: int = 0):
+        self.tracks = tracks
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+
+        self.by_title = {t['title']: t for t in tracks}
+        self.by_isrc = {t['isrc']: t for t in tracks}
+        self.by_query = {f"{t['title']} {t['artist']}": t for t in tracks}
+        self.albums = {}
+        for t in tracks:
+            self.albums.setdefault(t['album'], []).append(t)
+        # Songs each provider does not have, the same for every run with the same seed
+        self.missing = {
+            provider: {t['n'] for t in tracks if random.Random(f"{seed}:{provider}:{t['n']}").random() < miss_rate}
+            for provider in ('lrclib', 'spotify', 'musixmatch')
+        }
+
+        self.lock = Lock()
+        # Responses by endpoint and status code
+        self.requests = Counter()
+        # [first request started, last response sent] by song number
+        self.timings = {}
+        self.server = None
+
+    # Starts serving on a free port of the loopback interface, returns the base url
+    def start(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                standin.handle(self)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                standin.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    # Endpoint overrides of each provider, as the [ENDPOINTS:<provider>] config sections expect them
+    def endpoints(self):
+        return {
+            'lrclib': {
+                'API_EP': f"{self.url}/lrclib/api"
+            },
+            'spotify': {
+                'API_EP': f"{self.url}/spotify/v1",
+                'API_TOK_EP': f"{self.url}/spotify/api/token",
+                'LRC_TOK_EP': f"{self.url}/spotify/get_access_token?reason=transport&productType=web_player",
+                'LRC_EP_HEAD': f"{self.url}/spotify/color-lyrics/v2/track"
+            },
+            'musixmatch': {
+                'API_EP': f"{self.url}/musixmatch/ws/1.1"
+            }
+        }
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        started = time()
+        url = urlsplit(request.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        endpoint = url.path.strip('/')
+        for digit in '0123456789':
+            endpoint = endpoint.replace(digit, '')
+
+        status, body, track = self.route(url.path, params)
+        headers = {}
+        if 'token' not in url.path:
+            sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+            with self.lock:
+                fault = self.rng.random()
+            if fault < self.throttle_rate:
+                status, body, headers = 429, {}, {'Retry-After': str(self.retry_after)}
+            elif fault < self.throttle_rate + self.error_rate:
+                status, body = 500, {}
+
+        payload = json.dumps(body).encode()
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(payload)))
+        for name, value in headers.items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(payload)
+
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            if track is not None:
+                timing = self.timings.setdefault(track['n'], [started, started])
+                timing[1] = time()
+
+    # Returns the status, the body and the song the request is about (None when it is not about one)
+    def route(self, path: str, params: dict):
+        provider, _, rest = path.strip('/').partition('/')
+        try:
+            handler = getattr(self, f"_{provider}")
+        except AttributeError:
+            return 404, {}, None
+        return handler(rest, params)
+
+    def _has(self, provider: str, track: dict):
+        return track is not None and track['n'] not in self.missing[provider]
+
+    # Other songs of the same album, returned next to the match like the real searches do
+    def _decoys(self, track: dict, count: int = 2):
+        return [t for t in self.albums[track['album']] if t is not track][:count]
+
+    def _lrclib(self, path: str, params: dict):
+        track = self.by_title.get(params.get('track_name'))
+
+        if path == 'api/get':
+            found = (self._has('lrclib', track)
+                     and params.get('artist_name') == track['artist']
+                     and params.get('album_name') == track['album']
+                     and abs(float(params.get('duration', 0)) - track['duration']) <= 2)
+            if not found:
+                return 404, {'code': 404, 'name': 'TrackNotFound', 'message': 'Failed to find specified track'}, track
+            return 200, lrclib_record(track), track
+
+        if path == 'api/search':
+            if not self._has('lrclib', track):
+                return 200, [], track
+            return 200, [lrclib_record(t) for t in [track] + self._decoys(track)], track
+
+        return 404, {}, None
+
+    def _spotify(self, path: str, params: dict):
+        if path == 'api/token':
+            return 200, {'access_token': 'standin', 'token_type': 'Bearer', 'expires_in': 3600}, None
+        if path == 'get_access_token':
+            return 200, {
+                'clientId': 'standin',
+                'accessToken': 'standin',
+                'accessTokenExpirationTimestampMs': int(time() + 3600) * 1000,
+                'isAnonymous': False
+            }, None
+
+        if path == 'v1/search' and params.get('type') == 'album':
+            album, _, artist = params.get('q', '').removeprefix('album:').partition(' artist:')
+            tracks = self.albums.get(album)
+            if not tracks or tracks[0]['albumartist'] != artist:
+                return 200, {'albums': {'items': [], 'total': 0}}, None
+            items = [{
+                'id': self._album_id(tracks[0]),
+                'name': album,
+                'artists': [{'name': artist}],
+                'total_tracks': len(tracks)
+            }]
+            return 200, {'albums': {'items': items, 'total': len(items)}}, None
+
+        if path == 'v1/search':
+            q = params.get('q', '')
+            if q.startswith('isrc:'):
+                track = self.by_isrc.get(q.removeprefix('isrc:'))
+                items = [track] if self._has('spotify', track) else []
+            else:
+                track = self.by_title.get(q.partition(' artist:')[0])
+                items = [track] + self._decoys(track) if self._has('spotify', track) else []
+            items = [self._spotify_track(t) for t in items]
+            return 200, {'tracks': {'items': items, 'total': len(items), 'limit': 20, 'offset': 0}}, track
+
+        if path.startswith('v1/albums/') and path.endswith('/tracks'):
+            n = int(path.split('/')[2])
+            album = self.albums[self.tracks[n]['album']] if n < len(self.tracks) else []
+            items = [self._spotify_track(t, album=False) for t in album if self._has('spotify', t)]
+            return 200, {'items': items, 'next': None, 'total': len(items)}, None
+
+        if path.startswith('color-lyrics/v2/track/'):
+            n = int(path.rsplit('/', 1)[1])
+            track = self.tracks[n] if n < len(self.tracks) else None
+            if not self._has('spotify', track):
+                return 404, {}, track
+            lines = [
+                {'startTimeMs': str(ms), 'words': words, 'syllables': [], 'endTimeMs': '0'}
+                for ms, words in lyric_lines(track)
+            ]
+            return 200, {
+                'lyrics': {'syncType': 'LINE_SYNCED', 'lines': lines, 'provider': 'MusixMatch', 'language': 'en'},
+                'hasVocalRemoval': False
+            }, track
+
+        return 404, {}, None
+
+    # Albums are identified by the number of their first song, tracks by their own number
+    def _album_id(self, track: dict):
+        return f"{self.albums[track['album']][0]['n']:022d}"
+
+    def _spotify_track(self, track: dict, album: bool = True):
+        track_id = f"{track['n']:022d}"
+        item = {
+            'id': track_id,
+            'name': track['title'],
+            'artists': [{'name': track['artist']}],
+            'duration_ms': int(track['duration'] * 1000),
+            'external_ids': {'isrc': track['isrc']},
+            'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"}
+        }
+        if album:
+            item['album'] = {'id': self._album_id(track), 'name': track['album']}
+        return item
+
+    def _musixmatch(self, path: str, params: dict):
+        method = path.removeprefix('ws/1.1/')
+
+        if method == 'token.get':
+            return 200, mxm_message(200, {'user_token': 'standin'}), None
+
+        if method == 'macro.subtitles.get':
+            track = self.by_title.get(params.get('q_track'))
+            if not self._has('musixmatch', track) or track['artist'] != params.get('q_artist'):
+                calls = {name: mxm_message(404, '') for name in
+                         ('matcher.track.get', 'track.lyrics.get', 'track.subtitles.get')}
+                return 200, mxm_message(200, {'macro_calls': calls}), track
+            return 200, mxm_message(200, {'macro_calls': {
+                'matcher.track.get': mxm_message(200, {'track': mxm_track(track)}),
+                'track.lyrics.get': mxm_message(200, {'lyrics': {'lyrics_body': plain_lyrics(track)}}),
+                'track.subtitles.get': mxm_message(200, {'subtitle_list': [
+                    {'subtitle': {'subtitle_body': synced_lyrics(track)}}
+                ]})
+            }}), track
+
+        if method == 'track.search':
+            track = self.by_query.get(params.get('q'))
+            tracks = [track] + self._decoys(track) if self._has('musixmatch', track) else []
+            return 200, mxm_message(200, {'track_list': [{'track': mxm_track(t)} for t in tracks]}), track
+
+        if method == 'track.subtitle.get':
+            n = int(params.get('track_id', 0)) - 1
+            track = self.tracks[n] if 0 <= n < len(self.tracks) else None
+            if not self._has('musixmatch', track):
+                return 200, mxm_message(404, ''), track
+            body = plain_lyrics(track) if params.get('subtitle_format') == 'plain' else synced_lyrics(track)
+            return 200, mxm_message(200, {'subtitle': {'subtitle_body': body}}), track
+
+        return 404, {}, None
+
+def lyric_lines(track: dict, count: int = 30):
+    step = int(track['duration'] * 1000 / (count + 1))
+    return [(step * (i + 1), f"{track['title']} line {i + 1} of the synthetic lyrics") for i in range(count)]
+
+def synced_lyrics(track: dict):
+    lines = []
+    for ms, words in lyric_lines(track):
+        lines.append(f"[{ms // 60000:02d}:{ms // 1000 % 60:02d}.{ms % 1000 // 10:02d}] {words}")
+    return '\n'.join(lines)
+
+def plain_lyrics(track: dict):
+    return '\n'.join(words for _, words in lyric_lines(track))
+
+def lrclib_record(track: dict):
+    return {
+        'id': track['n'] + 1,
+        'trackName': track['title'],
+        'artistName': track['artist'],
+        'albumName': track['album'],
+        'duration': track['duration'],
+        'instrumental': False,
+        'plainLyrics': plain_lyrics(track),
+        'syncedLyrics': synced_lyrics(track)
+    }
+
+def mxm_track(track: dict):
+    return {
+        'track_id': track['n'] + 1,
+        'track_name': track['title'],
+        'artist_name': track['artist'],
+        'album_name': track['album'],
+        'track_length': int(track['duration']),
+        'instrumental': 0,
+        'has_subtitles': 1
+    }
+
+def mxm_message(status: int, body):
+    return {'message': {'header': {'status_code': status}, 'body': body}}
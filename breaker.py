@@ -0,0 +1,61 @@
+import logging
+
+from threading import Lock
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+'''
+Circuit breaker tracking the health of a provider
+After threshold consecutive failed requests the circuit opens and the provider is skipped
+for cooldown seconds, then one probe lookup is let through every probe_interval seconds
+until a request succeeds and the circuit closes again
+'''
+
+class CircuitBreaker:
+
+    THRESHOLD = 5
+    COOLDOWN = 60
+    PROBE_INTERVAL = 10
+
+    def __init__(self, name: str, threshold: int = None, cooldown: float = None, probe_interval: float = None):
+        self.name = name
+        self.threshold = threshold or self.THRESHOLD
+        self.cooldown = cooldown if cooldown is not None else self.COOLDOWN
+        self.probe_interval = probe_interval if probe_interval is not None else self.PROBE_INTERVAL
+        self.failures = 0
+        self.opened_at = None
+        self.last_probe = 0
+        self.lock = Lock()
+
+    # Returns False while the provider should be skipped
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            now = monotonic()
+            if now - self.opened_at < self.cooldown:
+                return False
+            if now - self.last_probe >= self.probe_interval:
+                self.last_probe = now
+                logger.debug(f"Probing {self.name}")
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"{self.name.capitalize()} is back, closing its circuit")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # A failed probe starts a new cooldown
+            if self.opened_at is not None or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"{self.name.capitalize()} failed {self.failures} times in a row, "
+                                   f"skipping it for {self.cooldown}s")
+                self.opened_at = monotonic()
@@ -0,0 +1,103 @@
+import json
+import logging
+import sqlite3
+
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Persistent cache of provider lookups, stored in a SQLite file
+Entries are keyed by provider, kind of lookup (search results, chosen track id, lyrics, album tracklist)
+and the normalized song key, and each kind has its own time to live
+Misses are stored as null values with a shorter time to live, so that songs
+that were not found are not queried again on every run
+When the file grows past max_size bytes the least recently used entries are evicted
+'''
+
+class LyricsCache:
+
+    TTLS = {
+        'search': 7 * 24 * 3600,
+        'track': 30 * 24 * 3600,
+        'lyrics': 30 * 24 * 3600,
+        'album': 30 * 24 * 3600,
+        'miss': 24 * 3600
+    }
+    MAX_SIZE = 256 * 1024 * 1024
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, ttls: dict = None, max_size: int = None):
+        self.ttls = {**self.TTLS, **(ttls or {})}
+        self.max_size = max_size or self.MAX_SIZE
+        self.lock = Lock()
+        self.puts = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS cache (
+                provider TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT,
+                expires_at INTEGER NOT NULL,
+                accessed_at INTEGER NOT NULL,
+                PRIMARY KEY (provider, kind, key)
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)')
+
+    # Returns a (hit, value) tuple, value is None for a cached miss
+    def get(self, provider: str, kind: str, key: str):
+        now = int(time())
+        with self.lock:
+            row = self.db.execute(
+                'SELECT value FROM cache WHERE provider = ? AND kind = ? AND key = ? AND expires_at > ?',
+                (provider, kind, key, now)).fetchone()
+            if row is None:
+                return False, None
+            self.db.execute(
+                'UPDATE cache SET accessed_at = ? WHERE provider = ? AND kind = ? AND key = ?',
+                (now, provider, kind, key))
+
+        return True, json.loads(row[0])
+
+    def put(self, provider: str, kind: str, key: str, value):
+        now = int(time())
+        ttl = self.ttls['miss'] if not value else self.ttls[kind.split(':')[0]]
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                (provider, kind, key, json.dumps(value), now + ttl, now))
+
+            self.puts += 1
+            if self.puts % self.EVICT_EVERY == 0:
+                self.__evict(now)
+
+    def __evict(self, now: int):
+        self.db.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+
+        size = self.db.execute('SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache').fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        # Evict the least recently used entries until the cache is back under 90% of its size
+        target = size - int(self.max_size * 0.9)
+        evicted = 0
+        rowids = []
+        for rowid, length in self.db.execute('SELECT rowid, LENGTH(value) FROM cache ORDER BY accessed_at'):
+            rowids.append((rowid,))
+            evicted += length
+            if evicted >= target:
+                break
+
+        self.db.execute('BEGIN')
+        self.db.executemany('DELETE FROM cache WHERE rowid = ?', rowids)
+        self.db.execute('COMMIT')
+        logger.debug(f"Evicted {len(rowids)} entries ({evicted} bytes) from the cache")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -1,40 +1,63 @@
 import logging
-import logging.config
 import argparse
 import datetime
 
 from configparser import ConfigParser
 
-import logging.config
-from os import chdir
+from os import path
 
 '''
 This module contains the shared code for the other modules
-In it are initialized the logger and the configuration parser
-The arguments parser is also defined here with the following options:
-    filepath: Path to the audio file, directory containing audio files or m3u playlist file
+In it are defined the setup of the logger, the loading of the configuration and the
+arguments parser, with the following options:
+    filepath: Path to the audio file, directory containing audio files or m3u playlist file (not needed by --worker)
     -t, --type: Type of lyrics to fetch (synced, plain)
     -w, --overwrite: Overwrite already present lyrics without asking
     -i, --interactive: Interactive mode (asks for confirmation before fetching lyrics)
     -o, --order: Specify the order of the getters
     -v, --verbose: Verbose output
     -d, --dump: Dump the lyrics to a file instead of embedding them in the audio file
-It also moves the working directory to the folder where the script is located
-And defines a shorthand for the datetime.now function
+    -c, --config: Path of the configuration file (config.cfg by default)
+    -j, --jobs: Number of songs to process concurrently
+    --provider-jobs: Maximum number of concurrent requests to a single provider
+    --no-cache: Do not read or write the lookup cache
+    --no-index: Parse the tags of every file instead of using the library index
+    --scan-jobs: Number of workers used to parse the tags of new or modified files
+    --scan-threads: Use threads instead of processes to parse the tags (for network storage)
+    --strategy: Query the providers one after the other (serial) or concurrently (race)
+    --hedge-delay: Seconds to wait before querying the next provider in race mode
+    --lrclib-db: Path of a local LRCLIB database dump, used by the lrclib-dump provider
+    --albums: Look each album up once and match its tracks locally instead of searching every song
+    --write-jobs: Number of workers writing the lyrics to disk
+    --metrics: Path of the JSON summary of the stage timers, provider outcomes and HTTP statuses
+    --prom: Path of the same metrics in the Prometheus text format
+    --metrics-interval: Seconds between exports of the metrics during the run
+    --journal: Path of the journal where the outcome of every song is appended
+    --resume: Leave out the songs that the journal says are done
+    --retry-errors: Only look up the songs that could not be read or whose lookup or write failed according to the journal
+    --watch: Keep running and look up the songs added or modified in the directory
+    --poll: Poll the directory every given seconds instead of using inotify (for network storage)
+    --debounce: Seconds without changes to wait for before looking up the new songs
+    --enqueue: Add the songs to the given work queue instead of processing them
+    --worker: Process the songs of the given work queue, along with the other workers
+    --adaptive: Reorder the providers of every song by their past hit rates and latencies
+    --prefetch: Number of songs looked up ahead of the one being confirmed in interactive mode
+Nothing is parsed or read at import time, so that the other modules can be imported as a
+library: parse_args and load_config are called by app.main, and the command line moves the
+working directory to SCRIPT_DIR first, which is where relative paths start from
+It also defines a shorthand for the datetime.now function
 '''
 
-chdir('/home/emiliano/Desktop/lrcgetter')
+SCRIPT_DIR = path.dirname(path.abspath(__file__))
 
 def now(format='%Y-%m-%d'):
     return datetime.datetime.now().strftime(format)
 
-config = ConfigParser()
-config.read('config.cfg')
-
 parser = argparse.ArgumentParser(description='Fetch lyrics from lrclib.net')
 
 parser.add_argument('filepath', 
-                    help='Path to the audio file, directory containing audio files or m3u playlist file')
+                    help='Path to the audio file, directory containing audio files or m3u playlist file',
+                    nargs='?')
 parser.add_argument('-t', '--type', 
                     help='Type of lyrics to fetch (synced, plain)', 
                     choices=['synced', 'plain'], 
@@ -46,7 +69,7 @@ parser.add_argument('-i', '--interactive',
                     help='Interactive mode (asks for confirmation before fetching lyrics)',
                     action='store_true')
 parser.add_argument('-o', '--order', 
-                    help='Specify the order of the getters, (comma separated), you can also shorten the names to any amount of letters (e.g. "s,mus,lr" for "spotify,musixmatch,lrclib")',
+                    help='Specify the order of the getters, (comma separated), you can also shorten the names to any amount of letters (e.g. "s,mus,lr" for "spotify,musixmatch,lrclib"), add lrclib-dump to use a local LRCLIB database dump',
                     default='spotify,lrclib,musixmatch')
 parser.add_argument('-v', '--verbose',
                     help='Verbose output',
@@ -54,13 +77,111 @@ parser.add_argument('-v', '--verbose',
 parser.add_argument('-d', '--dump',
                     help='Dump the lyrics to a file instead of embedding them in the audio file',
                     action='store_true')
+parser.add_argument('-c', '--config',
+                    help='Path of the configuration file, relative paths start from the folder of the script',
+                    default='config.cfg')
+parser.add_argument('-j', '--jobs',
+                    help='Number of songs to process concurrently (ignored in interactive mode)',
+                    type=int,
+                    default=1)
+parser.add_argument('--provider-jobs',
+                    help='Maximum number of concurrent requests to a single provider',
+                    type=int,
+                    default=4)
+parser.add_argument('--no-cache',
+                    help='Do not read or write the lookup cache',
+                    action='store_true')
+parser.add_argument('--no-index',
+                    help='Parse the tags of every file instead of using the library index',
+                    action='store_true')
+parser.add_argument('--scan-jobs',
+                    help='Number of workers used to parse the tags of new or modified files',
+                    type=int,
+                    default=1)
+parser.add_argument('--scan-threads',
+                    help='Use threads instead of processes to parse the tags (for network storage)',
+                    action='store_true')
+parser.add_argument('--strategy',
+                    help='Query the providers one after the other (serial) or concurrently (race), '
+                         'race still prefers the lyrics of the provider that comes first in the order',
+                    choices=['serial', 'race'],
+                    default='serial')
+parser.add_argument('--hedge-delay',
+                    help='Seconds to wait for a provider before also querying the next one in race mode',
+                    type=float,
+                    default=0)
+parser.add_argument('--lrclib-db',
+                    help='Path of a local LRCLIB database dump, used by the lrclib-dump provider')
+parser.add_argument('--albums',
+                    help='Look each album up once and match its tracks locally instead of searching every song '
+                         '(supported by spotify)',
+                    action='store_true')
+parser.add_argument('--write-jobs',
+                    help='Number of workers writing the lyrics to disk',
+                    type=int,
+                    default=2)
+parser.add_argument('--metrics',
+                    help='Write a JSON summary of the stage timers, provider outcomes and HTTP statuses to this path')
+parser.add_argument('--prom',
+                    help='Write the metrics in the Prometheus text format to this path')
+parser.add_argument('--metrics-interval',
+                    help='Seconds between exports of the metrics during the run, 0 exports them only at the end',
+                    type=float,
+                    default=0)
+parser.add_argument('--journal',
+                    help='Append the outcome of every song (per provider, with a timestamp) to this file')
+parser.add_argument('--resume',
+                    help='Leave out the songs that the journal says are done (saved, not found or skipped)',
+                    action='store_true')
+parser.add_argument('--retry-errors',
+                    help='Only look up the songs that could not be read or whose lookup or write failed according to the journal',
+                    action='store_true')
+parser.add_argument('--watch',
+                    help='After the first pass keep running and look up the songs added or modified in the directory',
+                    action='store_true')
+parser.add_argument('--poll',
+                    help='Poll the directory every given seconds instead of using inotify (for network storage)',
+                    type=float)
+parser.add_argument('--debounce',
+                    help='Seconds without changes to wait for before looking up the new songs in watch mode',
+                    type=float,
+                    default=2)
+parser.add_argument('--enqueue',
+                    help='Add the songs to this work queue (a SQLite file on storage shared with the workers) and exit')
+parser.add_argument('--worker',
+                    help='Process the songs of this work queue until it is empty, along with the other workers '
+                         '(the filepath is not needed)')
+parser.add_argument('--adaptive',
+                    help='Reorder the providers of every song by their past hit rates and latencies '
+                         '(for the whole library, the artist and the album), trying other orders now and then',
+                    action='store_true')
+parser.add_argument('--prefetch',
+                    help='Number of songs whose lyrics are looked up ahead of the one being confirmed in interactive mode',
+                    type=int,
+                    default=3)
+
+def parse_args(argv: list = None):
+    args = parser.parse_args(argv)
+
+    if not args.filepath and not args.worker:
+        parser.error('the filepath is required unless --worker is given')
+
+    if (args.resume or args.retry_errors) and not args.journal:
+        parser.error('--resume and --retry-errors require --journal')
+
+    return args
+
+def load_config(filepath: str):
+    config = ConfigParser()
+    config.read(filepath)
+    return config
 
-args = parser.parse_args()
+def setup_logger(verbose: bool = False):
+    import logging.config
 
-def setup_logger():
     format = '[%(asctime)s]'
 
-    if args.verbose:
+    if verbose:
         level = logging.DEBUG
         format += '%(levelname)s:%(filename)s:'
     else:
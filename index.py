@@ -0,0 +1,104 @@
+import logging
+import os
+import sqlite3
+
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+'''
+Persistent index of the scanned library, stored in a SQLite file
+Each audio file is keyed by its path and remembered together with its size and
+modification time, so that the tags of files that did not change since the last
+scan can be served from the index instead of being parsed again
+'''
+
+class LibraryIndex:
+
+    VERSION = 3
+    COMMIT_EVERY = 500
+    FIELDS = ('title', 'artist', 'album', 'albumartist', 'duration', 'isrc', 'has_lyrics')
+
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.pending = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        # The index is only a cache of the tags, rebuild it when its layout changes
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.db.execute('DROP TABLE IF EXISTS songs')
+            self.db.execute(f"PRAGMA user_version = {self.VERSION}")
+
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS songs (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                albumartist TEXT,
+                duration REAL,
+                isrc TEXT,
+                has_lyrics INTEGER NOT NULL
+            )''')
+        self.db.commit()
+
+    # Returns the indexed record of the file if it did not change since it was indexed
+    def get(self, path: str, stat: os.stat_result):
+        with self.lock:
+            row = self.db.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM songs WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row is None:
+            return None
+
+        record = dict(zip(self.FIELDS, row))
+        record['has_lyrics'] = bool(record['has_lyrics'])
+        record['filepath'] = path
+        return record
+
+    def put(self, path: str, stat: os.stat_result, record: dict):
+        values = [record[field] for field in self.FIELDS]
+        self.__write(
+            f"INSERT OR REPLACE INTO songs VALUES (?, ?, ?, {', '.join('?' * len(self.FIELDS))})",
+            (path, stat.st_size, stat.st_mtime_ns, *values))
+
+    # Called after the lyrics are embedded in the file, so that the next scan
+    # does not parse the file again just because its modification time changed
+    def mark_lyrics(self, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.__write(
+            'UPDATE songs SET size = ?, mtime_ns = ?, has_lyrics = 1 WHERE path = ?',
+            (stat.st_size, stat.st_mtime_ns, path))
+
+    # The index is only a cache, so a write is dropped rather than failing the song when another
+    # process sharing the file (e.g. a worker of the same work queue) holds it for too long
+    def __write(self, query: str, params: tuple):
+        with self.lock:
+            try:
+                self.db.execute(query, params)
+                self.__maybe_commit()
+            except sqlite3.OperationalError as e:
+                logger.debug(f"Skipping an update of the library index: {e}")
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+
+    def __maybe_commit(self):
+        self.pending += 1
+        if self.pending >= self.COMMIT_EVERY:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
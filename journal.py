@@ -0,0 +1,61 @@
+import json
+import logging
+import os
+
+from threading import Lock
+from time import time
+
+logger = logging.getLogger(__name__)
+
+'''
+Append-only journal of the outcome of every song of a run, one JSON object per line:
+    {"ts": 1700000000.0, "path": "/music/a.flac", "outcome": "not_found", "providers": {"spotify": "miss", "lrclib": "error"}}
+Each line is appended with a single write to a file opened with O_APPEND, so lines from
+concurrent workers (threads or processes) never interleave and a crash can at most cut the
+last line short, which load skips
+The last line of a path wins, so a resumed run can tell which songs are done and which
+ones failed and are worth retrying
+'''
+
+class Journal:
+
+    # Outcomes of songs that a resumed run does not need to look at again
+    DONE = ('saved', 'not_found', 'skipped')
+    # Outcomes of songs whose parsing, lookup or write failed, retried by --retry-errors
+    ERRORS = ('error', 'failed', 'unreadable')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def record(self, filepath: str, outcome: str, providers: dict = None, reason: str = None):
+        entry = {'ts': round(time(), 3), 'path': filepath, 'outcome': outcome}
+        if providers:
+            entry['providers'] = providers
+        if reason:
+            entry['reason'] = reason
+        line = (json.dumps(entry) + '\n').encode()
+        with self.lock:
+            os.write(self.fd, line)
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+
+    # Returns the last outcome recorded for each path
+    @staticmethod
+    def load(path: str):
+        outcomes = {}
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.debug(f"Skipping a truncated line of {path}")
+                        continue
+                    outcomes[entry['path']] = entry['outcome']
+        except FileNotFoundError:
+            pass
+        return outcomes
@@ -9,3 +9,12 @@ class InstrumentalTrackException(LrcException):
 
 class NoTokenException(LrcException):
     pass
+
+class ProviderException(LrcException):
+    pass
+
+class RateLimitedException(ProviderException):
+    pass
+
+class ProviderUnavailableException(ProviderException):
+    pass
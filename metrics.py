@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+
+from contextlib import contextmanager, nullcontext
+from threading import Event, Lock, Thread
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+'''
+Counters and timers of a run, exported as a JSON summary and in the Prometheus text format
+Every metric has a name and a set of labels (e.g. stage, provider, status), timers keep the
+count, the total and the maximum of the durations they measured
+Until enable is called, count and timer return right away, so instrumented code costs
+next to nothing when metrics are not requested
+'''
+
+class Metrics:
+
+    PREFIX = 'lrcgetter'
+
+    def __init__(self):
+        self.enabled = False
+        self.started = monotonic()
+        self.counters = {}
+        # [count, total seconds, max seconds] by metric
+        self.timers = {}
+        self.lock = Lock()
+        self.stopped = Event()
+        self.flusher = None
+
+    def enable(self):
+        self.enabled = True
+        self.started = monotonic()
+
+    def count(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            return nullcontext()
+        return self.__timer(name, labels)
+
+    @contextmanager
+    def __timer(self, name: str, labels: dict):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {key: list(timer) for key, timer in self.timers.items()}
+
+        summary = {'elapsed_s': round(monotonic() - self.started, 3), 'counters': {}, 'timers': {}}
+        for (name, labels), value in sorted(counters.items()):
+            summary['counters'].setdefault(name, []).append({**dict(labels), 'value': value})
+        for (name, labels), (count, total, peak) in sorted(timers.items()):
+            summary['timers'].setdefault(name, []).append({
+                **dict(labels),
+                'count': count,
+                'total_s': round(total, 6),
+                'mean_ms': round(total / count * 1000, 3),
+                'max_ms': round(peak * 1000, 3)
+            })
+
+        # Share of the lookups of each provider that found lyrics, failed requests included
+        lookups = {}
+        for entry in summary['counters'].get('lookups', []):
+            lookups.setdefault(entry['provider'], {})[entry['outcome']] = entry['value']
+        summary['providers'] = {
+            provider: {**outcomes, 'hit_rate': round(outcomes.get('hit', 0) / sum(outcomes.values()), 4)}
+            for provider, outcomes in sorted(lookups.items())
+        }
+        return summary
+
+    def prometheus(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {key: list(timer) for key, timer in self.timers.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {self.PREFIX}_{name}_total counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{self.PREFIX}_{name}_total{format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE {self.PREFIX}_{name}_seconds summary")
+            for (metric, labels), (count, total, _) in sorted(timers.items()):
+                if metric == name:
+                    lines.append(f"{self.PREFIX}_{name}_seconds_count{format_labels(labels)} {count}")
+                    lines.append(f"{self.PREFIX}_{name}_seconds_sum{format_labels(labels)} {total:.6f}")
+        return '\n'.join(lines) + '\n'
+
+    # Writes the JSON summary and the Prometheus file (either can be None) through temporary files,
+    # so that a reader never sees a partial export
+    def flush(self, json_path: str = None, prom_path: str = None):
+        if json_path:
+            write_atomic(json_path, json.dumps(self.summary(), indent=4))
+        if prom_path:
+            write_atomic(prom_path, self.prometheus())
+
+    # Flushes every interval seconds until stop is called
+    def start_flushing(self, interval: float, json_path: str = None, prom_path: str = None):
+        def flush_periodically():
+            while not self.stopped.wait(interval):
+                try:
+                    self.flush(json_path, prom_path)
+                except OSError as e:
+                    logger.warning(f"Failed to export the metrics: {e}")
+
+        self.flusher = Thread(target=flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.flusher:
+            self.flusher.join()
+
+    # Back to the state of a new instance, disabled and empty, so that a program that runs
+    # app.main more than once does not carry the metrics of a run over to the next one
+    def reset(self):
+        self.stop()
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+        self.enabled = False
+        self.started = monotonic()
+        self.flusher = None
+        self.stopped.clear()
+
+def format_labels(labels: tuple):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+def write_atomic(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# Shared by every module of the run, disabled until app.py enables it
+metrics = Metrics()
@@ -0,0 +1,58 @@
+from collections import deque
+from concurrent.futures import Executor, FIRST_COMPLETED, wait
+from time import monotonic
+from typing import Callable, Iterable
+
+'''
+Building blocks of the streaming pipeline used by app.py
+Each stage pulls items from the previous one lazily, so that memory stays flat
+regardless of the size of the library and work starts as soon as the first file is found
+'''
+
+# Like Executor.map, but keeps at most size items in flight and only pulls the next item
+# from the iterable when one is consumed, so that a slow stage applies backpressure
+# to the stages before it, results are yielded in the same order as the items
+def bounded_map(fn: Callable, iterable: Iterable, pool: Executor, size: int):
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= size:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# Waits up to timeout seconds for the futures, which are ordered by priority and
+# resolve to a falsy value on a miss, returns True as soon as a winner is certain, that is when
+# a future hit and all the ones before it missed, and False when they all missed or time ran out
+def wait_for_winner(futures: list, timeout: float):
+    deadline = monotonic() + timeout
+    while True:
+        for future in futures:
+            if not future.done():
+                break
+            if not future.cancelled() and not future.exception() and future.result():
+                return True
+        else:
+            return False
+
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        wait([f for f in futures if not f.done()], timeout=remaining, return_when=FIRST_COMPLETED)
+
+# Submits fn for the item being consumed and up to ahead items past it, yielding (item, future)
+# as soon as the item is reached rather than once its result is ready, so that the consumer
+# can do something else (e.g. wait for an answer of the user) while the next items are processed
+# The items not reached yet are cancelled when the consumer stops early
+def lookahead(fn: Callable, iterable: Iterable, pool: Executor, ahead: int):
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append((item, pool.submit(fn, item)))
+            if len(pending) > ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        for _, future in pending:
+            future.cancel()
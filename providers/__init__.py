@@ -0,0 +1,22 @@
+from importlib import import_module
+
+'''
+Registry of the providers by name, mapped to the module and the class implementing them
+A provider module (and requests with the rest of what the getters need) is only
+imported when the provider is first asked for, so that a run with --order lrclib does not
+pay for Spotify and Musixmatch, and importing the package costs nothing
+'''
+
+PROVIDERS = {
+    'lrclib': ('providers.lrclib', 'Lrclib'),
+    'spotify': ('providers.spotify', 'Spotify'),
+    'musixmatch': ('providers.musixmatch', 'Musixmatch'),
+    'lrclib-dump': ('providers.lrclib_dump', 'LrclibDump')
+}
+
+def provider_class(name: str):
+    try:
+        module, cls = PROVIDERS[name]
+    except KeyError:
+        raise ValueError(f"Provider {name} not found") from None
+    return getattr(import_module(module), cls)
@@ -1,89 +1,283 @@
-import json
 import logging
+import random
 import re
-import requests as req
 
-from rapidfuzz import fuzz
-from time import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from time import monotonic, sleep
 from typing import Union, Callable
 
+from breaker import CircuitBreaker
+from cache import LyricsCache
+from lrc import ProviderException, ProviderUnavailableException, RateLimitedException
+from metrics import metrics
+from ratelimit import RateLimiter
+from singleflight import SingleFlight
 from song import Song
+from tokens import TokenBroker
 
 logger = logging.getLogger(__name__)
 
+# Removes the featuring markers and the separators between the artists before comparing
+SPLITTER = re.compile(r'(?:feat.)|(?:ft.)|(?:with)|(?:\s[xX]\s(?!([Aa]mbassador)))|\s*[&,×+;\/·]\s*')
+
+def normalize(text: str):
+    return SPLITTER.sub('', text.lower())
+
+# Scores the results against the song based on the edit distance between
+# results' "compare_fn(t)" and query's "song.title song.artist song.album"
+# Using rapidfuzz fuzz.token_set_ratio as the score function, the query is normalized once
+# and all the candidates are scored in a single process.extractOne call
+# rapidfuzz is imported by the first search, lookups answered by the cache never need it
+class Matcher:
+    def __init__(self, song: Song):
+        self.query = normalize(f"{song.title} {song.artist} {song.album}")
+
+    # Returns the best result together with its score, (None, 0) when there are no results
+    def best(self, results: list, compare_fn: Union[str, Callable[[dict], str]]):
+        if isinstance(compare_fn, str):
+            key = compare_fn
+            compare_fn = lambda t: t[key]
+
+        from rapidfuzz import fuzz, process
+
+        choices = [normalize(compare_fn(t)) for t in results]
+        match = process.extractOne(self.query, choices, scorer=fuzz.token_set_ratio, processor=None)
+        if match is None:
+            return None, 0
+
+        _, score, i = match
+        return results[i], score
+
 class Getter:
+
+    NAME = None
+
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 15
+    RETRIES = 3
+    BACKOFF = 0.5
+    POOL_SIZE = 10
+    # Responses that mean the request failed rather than the song not being there
+    FAILURE_CODES = (401, 403)
+    # Requests per second, None for no limit
+    RATE = None
+    # Number of recent lookups whose result is kept in memory and shared by identical songs
+    DEDUP_SIZE = 4096
+    # Seconds, songs whose durations round to the same bucket are considered the same recording
+    DEDUP_DURATION_BUCKET = 2
+    MAX_RETRY_AFTER = 300
+
+    def __init__(self, connect_timeout: float = None, read_timeout: float = None,
+                 retries: int = None, backoff: float = None, pool_size: int = None,
+                 cache: LyricsCache = None, tokens: TokenBroker = None, rate: float = None,
+                 breaker_threshold: int = None, breaker_cooldown: float = None, endpoints: dict = None):
+        self.cache = cache
+        self.tokens = tokens
+        self.flights = SingleFlight(memo=self.DEDUP_SIZE)
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else self.CONNECT_TIMEOUT,
+            read_timeout if read_timeout is not None else self.READ_TIMEOUT
+        )
+        self.retries = retries if retries is not None else self.RETRIES
+        self.backoff = backoff if backoff is not None else self.BACKOFF
+
+        rate = rate if rate is not None else self.RATE
+        self.limiter = RateLimiter(rate) if rate else None
+        self.breaker = CircuitBreaker(self.NAME, breaker_threshold, breaker_cooldown)
+
+        # One keep-alive connection pool per provider, shared by all the worker threads,
+        # created by the first request (see __session)
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.session = None
+        self.session_lock = Lock()
+
+        # Overrides the endpoint class attributes of the provider, e.g. to point it at a local stand-in server
+        for name, url in (endpoints or {}).items():
+            if not hasattr(type(self), name):
+                raise ValueError(f"Provider {self.NAME} has no endpoint {name}")
+            setattr(self, name, url)
+
     def get_lyrics(self, song: Song, type: str):
         raise NotImplementedError
-    
+
+    # Providers that can list the tracks of an album override this to resolve the track ids
+    # of all the songs of an album at once, storing them in song.ids
+    def resolve_album(self, songs: list):
+        pass
+
+    # Entry point used by app.py, get_lyrics behind the lyrics cache
+    # Identical songs (same title, artist and approximate duration, e.g. the same recording on
+    # an album and a compilation, or as FLAC and MP3) share a single lookup and its result
+    # on_fetched(lyrics, seconds) is only called when the lyrics were actually fetched from the
+    # provider, not when the lookup was answered by the cache or by an identical song
+    def lookup(self, song: Song, type: str, on_fetched: Callable = None):
+        def fetch():
+            start = monotonic()
+            lyrics = self.__get_lyrics(song, type)
+            if on_fetched:
+                on_fetched(lyrics, monotonic() - start)
+            return lyrics
+
+        key = (type, song.key(album=False, duration_bucket=self.DEDUP_DURATION_BUCKET))
+        return self.flights.do(key, lambda: self._cached(f"lyrics:{type}", song.key(), fetch))
+
+    # Cached lookups are still served while the circuit of the provider is open
+    def __get_lyrics(self, song: Song, type: str):
+        if not self.breaker.allow():
+            raise ProviderUnavailableException('is unavailable, skipping it')
+        return self.get_lyrics(song, type)
+
+    # Returns the cached value for the lookup if there is one, otherwise calls fetch and caches its result
+    # Exceptions raised by fetch are not cached, so failed requests are retried on the next run
+    def _cached(self, kind: str, key: str, fetch: Callable):
+        if not self.cache:
+            return self.__fetch(kind, fetch)
+
+        hit, value = self.cache.get(self.NAME, kind, key)
+        metrics.count('cache', provider=self.NAME, kind=kind, result='hit' if hit else 'miss')
+        if hit:
+            logger.debug(f"Cache hit for {self.NAME} {kind}")
+            return value
+
+        value = self.__fetch(kind, fetch)
+        self.cache.put(self.NAME, kind, key, value)
+        return value
+
+    # Times the lookups that missed the cache by kind (search, track, album, lyrics)
+    def __fetch(self, kind: str, fetch: Callable):
+        with metrics.timer('stage', stage=kind.split(':')[0], provider=self.NAME):
+            return fetch()
+
+    # requests is only imported along with the session, so that the runs answered by the cache
+    # (or by a local provider like lrclib-dump) never pay for it
+    def __session(self):
+        with self.session_lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                self.session = requests.Session()
+                self.session.mount('https://', adapter)
+                self.session.mount('http://', adapter)
+            return self.session
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+    # Retries connection errors, timeouts, broken or undecodable bodies and 5xx responses with exponential backoff and full jitter
+    # 429 responses slow down the rate limiter and are retried after the Retry-After the provider sent
+    # Raises ProviderException (RateLimitedException when throttled) once the retries are exhausted,
+    # so that a failed request is not mistaken for a song that the provider does not have
+    def _request(self, method: str, endpoint: str, **kwargs):
+        import requests
+
+        session = self.__session()
+        attempt = 0
+        throttled = 0
+        while True:
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                r = self.__send(session, method, endpoint, **kwargs)
+            except requests.RequestException as e:
+                metrics.count('http_errors', provider=self.NAME, error=type(e).__name__)
+                error = e
+            else:
+                if r.status_code == 429:
+                    throttled += 1
+                    if throttled > self.retries:
+                        raise RateLimitedException(f"Rate limited by {endpoint}, retry later")
+                    metrics.count('http_retries', provider=self.NAME, reason='throttled')
+                    self.__throttle(r)
+                    continue
+                if r.status_code in self.FAILURE_CODES:
+                    raise ProviderException(f"Request to {endpoint} failed: status code {r.status_code}")
+                if r.status_code < 500:
+                    if self.limiter:
+                        self.limiter.on_success()
+                    return r
+                error = f"status code {r.status_code}"
+
+            if attempt >= self.retries:
+                self.breaker.record_failure()
+                raise ProviderException(f"Request to {endpoint} failed: {error}")
+
+            metrics.count('http_retries', provider=self.NAME, reason='error')
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            logger.debug(f"Request to {endpoint} failed ({error}), retrying in {delay:.2f}s")
+            sleep(delay)
+            attempt += 1
+
+    # Any answer below 500 means the provider is up, even if it does not have the song
+    def __send(self, session, method: str, endpoint: str, **kwargs):
+        with metrics.timer('http_request', provider=self.NAME):
+            r = session.request(method, endpoint, timeout=self.timeout, **kwargs)
+        metrics.count('http_responses', provider=self.NAME, status=r.status_code)
+        if r.status_code < 500:
+            self.breaker.record_success()
+        return r
+
+    def __throttle(self, r):
+        retry_after = self.__retry_after(r)
+        logger.debug(f"Rate limited by {r.url}, Retry-After: {retry_after}")
+
+        if self.limiter:
+            self.limiter.on_throttle(retry_after)
+        else:
+            sleep(retry_after if retry_after is not None else self.backoff)
+
+    # Retry-After is either a number of seconds or an HTTP date
+    def __retry_after(self, r):
+        value = r.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(seconds, 0), self.MAX_RETRY_AFTER)
+
     def _get(self, endpoint: str, params: dict = {}, headers: dict = {}):
-        r = req.get(endpoint, params=params, headers=headers)
+        r = self._request('GET', endpoint, params=params, headers=headers)
 
         if not r.ok:
             #logger.warning(f"Failed to get data from {r.url}: {r.status_code}")
             return None
         
-        return r.json()
+        return self.__json(r, endpoint)
 
     def _post(self, endpoint: str, data: dict, headers: dict):
-        r = req.post(endpoint, data=data, headers=headers)
+        r = self._request('POST', endpoint, data=data, headers=headers)
 
         if not r.ok:
             #logger.warning(f"Failed to get data from {r.url}: {r.status_code}")
             return None
         
-        return r.json()
-    
-    # Sort results based on the score produced by calculating the edit distance between the found song and the song to be searched
-    # results' "t['name] t['artists']" and query's "song.title song.artist"
-    # Using fuzzywuzzy fuzz.token_set_ratio as the score function
-
-    def __similarity(self, a: str, b: str):
-        splitter = re.compile(r'(?:feat.)|(?:ft.)|(?:with)|(?:\s[xX]\s(?!([Aa]mbassador)))|\s*[&,×+;\/·]\s*')
-        a = splitter.sub('', a.lower())
-        b = splitter.sub('', b.lower())
-
-        return fuzz.token_set_ratio(a, b)
+        return self.__json(r, endpoint)
     
-    def __acceptable_match(self, a: str, b: str, min: int):
-        return round(self.__similarity(a, b)) >= min
-
-    def __sort_results(self, results: list, compare_fn, song: str):
-        if isinstance(compare_fn, str):
-            def compare_fn(t):
-                return t[compare_fn]
-            
-        def sort_fn(t):
-            return self.__similarity(compare_fn(t), song)
-
-        return sorted(results, key=sort_fn, reverse=True)
+    # A body that is not JSON (a captive portal, a truncated answer) is a failed request,
+    # not a song that the provider does not have
+    def __json(self, r, endpoint: str):
+        try:
+            return r.json()
+        except ValueError as e:
+            raise ProviderException(f"Invalid response from {endpoint}: {e}")
 
+    # Picks the result closest to the song using the batched Matcher below
     def _get_best_match(self, results: list, compare_fn: Union[str, Callable[[dict], str]], song: Song, min: int = 70):
         if not results:
             return None
-        
-        song_str = f"{song.title} {song.artist} {song.album}"
-
-        result = self.__sort_results(results, compare_fn, song_str)
-        best_match = result[0]
 
-        compare = (
-            best_match[compare_fn] 
-            if isinstance(compare_fn, str) 
-            else compare_fn(best_match)
-        )
+        with metrics.timer('stage', stage='rank', provider=self.NAME):
+            best_match, score = Matcher(song).best(results, compare_fn)
 
-        if self.__acceptable_match(song_str, compare, min):
+        if round(score) >= min:
             return best_match
         return None
-    
-    def _find_token(self, token_file):
-        try:
-            with open(token_file, 'r') as f:
-                tok = json.load(f)
-        except FileNotFoundError:
-            return None
-
-        if int(time()) > tok.get('expires_at', 0):
-            return None
-
-        return tok.get('token', None)
\ No newline at end of file
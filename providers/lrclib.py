@@ -1,5 +1,4 @@
 import logging
-import requests
 
 from providers.getter import Getter
 from song import Song
@@ -8,17 +7,40 @@ logger = logging.getLogger(__name__)
 
 class Lrclib(Getter):
 
+    NAME = 'lrclib'
+    RATE = 10
     API_EP = 'https://lrclib.net/api'
     USER_AGENT = 'lyrics_getter_cmd, v0.0.0, (no source link yet)'
 
     def get_lyrics(self, song, type):
-        tracks = self.__get_songs(song)
+        # The exact lookup by signature skips the search and the ranking when it hits
+        track = self._cached('track', song.key(), lambda: self.__get_song(song))
 
-        compare = lambda t: f"{t['trackName']} {t['artistName']} {t['albumName']}"
-        track = self._get_best_match(tracks, compare, song)
+        if not track:
+            tracks = self._cached('search', song.key(), lambda: self.__get_songs(song))
+
+            compare = lambda t: f"{t['trackName']} {t['artistName']} {t['albumName']}"
+            track = self._get_best_match(tracks, compare, song)
+        if not track:
+            return None
 
         return track[f"{type}Lyrics"]
 
+    def __get_song(self, song: Song):
+        if not song.duration:
+            return None
+
+        params = {
+            'track_name': song.title,
+            'artist_name': song.artist,
+            'album_name': song.album,
+            'duration': round(song.duration)
+        }
+        headers = { 'User-Agent': self.USER_AGENT }
+        url = f"{self.API_EP}/get"
+
+        return self._get(url, params, headers)
+
     def __get_songs(self, song: Song):
         params = {
             'track_name': song.title,
@@ -0,0 +1,116 @@
+import logging
+import sqlite3
+import sys
+
+from threading import local
+
+from providers.getter import Getter
+from song import Song
+
+logger = logging.getLogger(__name__)
+
+'''
+Offline provider backed by a local LRCLIB database dump (https://lrclib.net/db-dumps)
+The dump is opened read-only, candidates are found with an exact lookup on the
+normalized track and artist names and, when that misses, through the tracks_fts
+full-text index, then ranked by _get_best_match like the results of the other providers
+Dumps that lack the indexes can be prepared once with: python -m providers.lrclib_dump DUMP
+'''
+
+class LrclibDump(Getter):
+
+    NAME = 'lrclib-dump'
+    MAX_CANDIDATES = 20
+
+    SELECT = '''
+        SELECT t.name, t.artist_name, t.album_name, t.duration, l.synced_lyrics, l.plain_lyrics
+        FROM tracks t JOIN lyrics l ON l.id = t.last_lyrics_id
+    '''
+
+    def __init__(self, db_path: str, **kwargs):
+        super().__init__(**kwargs)
+        # Local lookups are cheaper than the lookup cache itself
+        self.cache = None
+        self.db_path = db_path
+        self.local = local()
+
+        self.has_fts = self.__db().execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'tracks_fts'").fetchone() is not None
+        if not self.has_fts:
+            logger.warning(f"{db_path} has no full-text index, only exact matches will be found")
+
+    def get_lyrics(self, song: Song, type: str):
+        tracks = self.__get_songs(song)
+
+        compare = lambda t: f"{t['trackName']} {t['artistName']} {t['albumName']}"
+        track = self._get_best_match(tracks, compare, song)
+        if not track:
+            return None
+
+        return track[f"{type}Lyrics"]
+
+    # sqlite3 connections can't be shared between threads, each worker opens its own
+    def __db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+            self.local.db = db
+        return db
+
+    def __get_songs(self, song: Song):
+        db = self.__db()
+        rows = db.execute(
+            f"{self.SELECT} WHERE t.name_lower = ? AND t.artist_name_lower = ? LIMIT ?",
+            (normalize(song.title), normalize(song.artist), self.MAX_CANDIDATES)).fetchall()
+
+        query = fts_query(song)
+        if not rows and self.has_fts and query:
+            rows = db.execute(
+                f"{self.SELECT} WHERE t.id IN (SELECT rowid FROM tracks_fts WHERE tracks_fts MATCH ? ORDER BY rank LIMIT ?)",
+                (query, self.MAX_CANDIDATES)).fetchall()
+
+        return [
+            {
+                'trackName': name,
+                'artistName': artist,
+                'albumName': album,
+                'duration': duration,
+                'syncedLyrics': synced,
+                'plainLyrics': plain
+            }
+            for name, artist, album, duration, synced, plain in rows
+        ]
+
+def normalize(text: str):
+    return ' '.join((text or '').lower().split())
+
+# Matches any of the words of the title and of the artist, the candidates are ordered by rank
+# Every word is quoted, so that FTS5 does not interpret it as an operator
+def fts_query(song: Song):
+    def terms(column, text):
+        words = [f'"{w}"' for w in normalize(text).replace('"', ' ').split()]
+        return f"{column}:({' OR '.join(words)})" if words else ''
+
+    return ' AND '.join(filter(None, [
+        terms('name_lower', song.title),
+        terms('artist_name_lower', song.artist)
+    ]))
+
+# Creates the indexes used by the provider if the dump does not have them yet
+def build_index(db_path: str):
+    db = sqlite3.connect(db_path)
+    db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tracks_name_artist_lower
+        ON tracks (name_lower, artist_name_lower)''')
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'tracks_fts'").fetchone():
+        db.execute('''
+            CREATE VIRTUAL TABLE tracks_fts USING fts5(
+                name_lower, album_name_lower, artist_name_lower,
+                content='tracks', content_rowid='id'
+            )''')
+        db.execute("INSERT INTO tracks_fts(tracks_fts) VALUES ('rebuild')")
+    db.commit()
+    db.close()
+
+if __name__ == '__main__':
+    build_index(sys.argv[1])
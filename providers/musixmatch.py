@@ -1,58 +1,151 @@
-import json
 import logging
-import os
 
 from time import time
 
 from lrc import NoTokenException
+from metrics import metrics
 from providers.getter import Getter
 from song import Song
+from tokens import TokenBroker
 
 logger = logging.getLogger(__name__)
 
 class Musixmatch(Getter):
-    def __init__(self, token_dir: str):
-        self.api_ep = 'https://apic-desktop.musixmatch.com/ws/1.1'
+
+    NAME = 'musixmatch'
+    RATE = 2
+    API_EP = 'https://apic-desktop.musixmatch.com/ws/1.1'
+
+    def __init__(self, token_dir: str, **kwargs):
+        super().__init__(**kwargs)
         self.api_token = None
         self.token_dir = token_dir
-        self.api_tok_file = os.path.join(token_dir, 'mxm_api_token.json')
+        # Cleared when the combined call turns out not to be supported, so that the rest
+        # of the run goes straight to the search and subtitle calls
+        self.macro_available = True
+
+        if not self.tokens:
+            self.tokens = TokenBroker(token_dir)
 
     def get_lyrics(self, song: Song, type: str = None):
         try: self.__get_api_token()
         except NoTokenException: raise
 
-        tracks = self.__search(song.title, song.artist)
+        if self.macro_available:
+            with metrics.timer('stage', stage='fetch', provider=self.NAME):
+                calls = self.__get_macro(song)
+            if calls is not None:
+                return self.__parse_macro(calls, song, type)
+
+        track_id = self._cached('track', song.key(), lambda: self.__find_track(song))
+        if not track_id:
+            return None
+
+        with metrics.timer('stage', stage='fetch', provider=self.NAME):
+            return self.__get_song_lyrics(track_id, type)
+
+    def __find_track(self, song: Song):
+        tracks = self._cached('search', song.key(), lambda: self.__search(song.title, song.artist))
         compare = lambda t: f"{t['track']['track_name']} {t['track']['artist_name']} {t['track']['album_name']}"
         track = self._get_best_match(tracks, compare, song)
         if not track:
             return None
 
-        track_id = track['track']['track_id']
-        return self.__get_song_lyrics(track_id, type)
+        return track['track']['track_id']
 
     def __get_api_token(self):
-        token = self._find_token(self.api_tok_file)
-        if token and self.api_token:
-            self.api_token = token
-            return
+        self.api_token = self.tokens.get('mxm_api_token', self.__request_api_token)
 
+    def __request_api_token(self):
         headers = { 'Accept': 'application/json' }
         params = { 'app_id': 'web-desktop-app-v1.0' }
-        url = f"{self.api_ep}/token.get"
+        url = f"{self.API_EP}/token.get"
 
         body = self._get(url, params=params, headers=headers)
 
         if not body:
             raise NoTokenException('Failed to get API token')
-        
-        token = {
+
+        return {
             'token': body['message']['body']['user_token'],
             'expires_at': int(time()) + 600
         }
 
-        with open(self.api_tok_file, 'w') as f:
-            json.dump(token, f)
-    
+    # Matches the track and returns its subtitles and lyrics in a single round-trip
+    # Returns the macro calls, or None when the combined call failed and the song has to go
+    # through the search and subtitle calls
+    # Only an endpoint that does not exist or answers without macro calls turns the combined call
+    # off for the rest of the run, a rejected user token is renewed and the call retried once,
+    # other failures (e.g. a captcha) only affect this song
+    def __get_macro(self, song: Song, renew_token: bool = True):
+        headers = { 'Accept': 'application/json' }
+        params = {
+            'app_id': 'web-desktop-app-v1.0',
+            'usertoken': self.api_token,
+            'format': 'json',
+            'namespace': 'lyrics_richsynched',
+            'subtitle_format': 'lrc',
+            'q_track': song.title,
+            'q_artist': song.artist,
+            'q_album': song.album,
+            'q_duration': round(song.duration or 0)
+        }
+        url = f"{self.API_EP}/macro.subtitles.get"
+
+        r = self._request('GET', url, params=params, headers=headers)
+        if r.status_code == 404:
+            return self.__disable_macro('status code 404')
+        if not r.ok:
+            return None
+
+        try:
+            message = r.json()['message']
+            status = message['header']['status_code']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+        if status == 401 and renew_token:
+            self.tokens.invalidate('mxm_api_token', self.api_token)
+            self.__get_api_token()
+            return self.__get_macro(song, renew_token=False)
+        if status != 200:
+            logger.debug(f"Musixmatch macro call failed with status {status}, falling back to search and subtitle calls")
+            return None
+
+        body = message.get('body')
+        calls = body.get('macro_calls') if isinstance(body, dict) else None
+        if calls is None:
+            return self.__disable_macro('no macro calls in the response')
+        return calls
+
+    def __disable_macro(self, reason: str):
+        logger.debug(f"Musixmatch macro call unavailable ({reason}), falling back to search and subtitle calls")
+        self.macro_available = False
+        return None
+
+    def __parse_macro(self, calls: dict, song: Song, type: str):
+        track = self.__macro_body(calls, 'matcher.track.get').get('track')
+        compare = lambda t: f"{t['track_name']} {t['artist_name']} {t['album_name']}"
+        if not track or not self._get_best_match([track], compare, song):
+            return None
+        if track.get('instrumental'):
+            return None
+
+        if type == 'plain':
+            lyrics = self.__macro_body(calls, 'track.lyrics.get').get('lyrics')
+            return lyrics['lyrics_body'] if lyrics else None
+
+        subtitles = self.__macro_body(calls, 'track.subtitles.get').get('subtitle_list')
+        return subtitles[0]['subtitle']['subtitle_body'] if subtitles else None
+
+    # Failed calls inside the macro come back with an empty list or string as their body
+    def __macro_body(self, calls: dict, name: str):
+        message = calls.get(name, {}).get('message', {})
+        body = message.get('body')
+        if message.get('header', {}).get('status_code') != 200 or not isinstance(body, dict):
+            return {}
+        return body
+
     def __get_song_lyrics(self, track_id, type):
         headers = { 'Accept': 'application/json' }
         params = {
@@ -62,7 +155,7 @@ class Musixmatch(Getter):
             'subtitle_format': 'plain' if type == 'plain' else 'lrc',
             'translation_fields_set': 'minimal'
         }
-        url = f"{self.api_ep}/track.subtitle.get"
+        url = f"{self.API_EP}/track.subtitle.get"
 
         body = self._get(url, params=params, headers=headers)
         
@@ -81,7 +174,7 @@ class Musixmatch(Getter):
             'page': 1,
             'page_size': 5
         }
-        url = f"{self.api_ep}/track.search"
+        url = f"{self.API_EP}/track.search"
 
         body = self._get(url, params=params, headers=headers)
 
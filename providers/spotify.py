@@ -1,26 +1,32 @@
-import json
 import logging
-import os
 
 from time import time
 
 from lrc import NoTokenException
+from metrics import metrics
 from providers.getter import Getter
 from song import Song
+from tokens import TokenBroker
 
 logger = logging.getLogger(__name__)
 
 class Spotify(Getter):
 
+    NAME = 'spotify'
+    RATE = 10
     API_EP = 'https://api.spotify.com/v1'
     API_TOK_EP = 'https://accounts.spotify.com/api/token'
     LRC_TOK_EP = 'https://open.spotify.com/get_access_token?reason=transport&productType=web_player'
     LRC_EP_HEAD = 'https://spclient.wg.spotify.com/color-lyrics/v2/track'
     LRC_EP_TAIL = '?format=json&vocalRemoval=false&market=from_token'
 
+    # Seconds of difference allowed between a local file and a track of the album
+    DURATION_TOLERANCE = 3
+
     USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/101.0.0.0 Safari/537.36'
 
-    def __init__(self, client_id, client_secret, sp_dc, tokens_dir):
+    def __init__(self, client_id, client_secret, sp_dc, tokens_dir, **kwargs):
+        super().__init__(**kwargs)
         self.CLIENT_ID = client_id
         self.CLIENT_SECRET = client_secret
         self.SP_DC = sp_dc
@@ -29,32 +35,102 @@ class Spotify(Getter):
         self.lrc_token = None
         self.tokens_dir = tokens_dir
 
-        if not os.path.exists(tokens_dir):
-            os.makedirs(tokens_dir)
-
-        self.api_tok_file = os.path.join(tokens_dir, 'api_token.json')
-        self.lrc_tok_file = os.path.join(tokens_dir, 'lrc_token.json')
+        if not self.tokens:
+            self.tokens = TokenBroker(tokens_dir)
 
     def get_lyrics(self, song: Song, type: str = None):
+        track_id = song.ids.get(self.NAME) or self._cached('track', song.key(), lambda: self.__find_track(song))
+
+        if not track_id:
+            return None
+
+        try: self.__get_lrc_token()
+        except NoTokenException: raise
+
+        with metrics.timer('stage', stage='fetch', provider=self.NAME):
+            lyrics = self.__get_song_lyrics(track_id)
+
+        return self.__parse_lyrics(lyrics, type)
+
+    def __find_track(self, song: Song):
         try: self.__get_api_token()
         except NoTokenException: raise
-        
-        tracks = self.__search(song.title, song.artist)        
+
+        # An ISRC identifies the recording, so the first result is taken without ranking
+        if song.isrc:
+            tracks = self.__search_isrc(song.isrc)
+            if tracks:
+                return self.__track_id(tracks[0])
+
+        tracks = self._cached('search', song.key(), lambda: self.__search(song.title, song.artist))
         compare = lambda t: f"{t['name']} {' '.join([a['name'] for a in t['artists']])} {t['album']['name']}"
         track = self._get_best_match(tracks, compare, song)
 
         if not track:
             return None
 
-        track_url = track['external_urls']['spotify']
-        track_id = track_url.split('/')[-1]
+        return self.__track_id(track)
 
-        try: self.__get_lrc_token()
+    # Looks the album up once and matches every song against its tracklist by title and duration,
+    # so that the songs of the album don't need a search each
+    def resolve_album(self, songs: list):
+        try: self.__get_api_token()
         except NoTokenException: raise
 
-        lyrics = self.__get_song_lyrics(track_id)
+        album = Song(title='', artist=songs[0].albumartist or songs[0].artist, album=songs[0].album)
+        tracks = self._cached('album', album.key(), lambda: self.__get_album_tracks(album))
+        if not tracks:
+            return
 
-        return self.__parse_lyrics(lyrics, type)
+        compare = lambda t: f"{t['name']} {' '.join(t['artists'])} {t['album']}"
+        for song in songs:
+            candidates = [
+                t for t in tracks
+                if not song.duration or abs(t['duration_ms'] / 1000 - song.duration) <= self.DURATION_TOLERANCE
+            ]
+            track = self._get_best_match(candidates, compare, song)
+            if track:
+                song.ids[self.NAME] = track['id']
+
+    def __get_album_tracks(self, album: Song):
+        headers = { 'Authorization': f'Bearer {self.api_token}' }
+        params = {
+            'q': f'album:{album.album} artist:{album.artist}',
+            'type': 'album',
+            'limit': 5
+        }
+        body = self._get(f"{self.API_EP}/search", params=params, headers=headers)
+        if not body:
+            return None
+
+        compare = lambda a: f"{' '.join([ar['name'] for ar in a['artists']])} {a['name']}"
+        match = self._get_best_match(body['albums']['items'], compare, album)
+        if not match:
+            return None
+
+        tracks = []
+        url = f"{self.API_EP}/albums/{match['id']}/tracks"
+        params = { 'limit': 50 }
+        while url:
+            body = self._get(url, params=params, headers=headers)
+            if not body:
+                break
+            tracks.extend({
+                'id': t['id'],
+                'name': t['name'],
+                'artists': [a['name'] for a in t['artists']],
+                'album': match['name'],
+                'duration_ms': t['duration_ms']
+            } for t in body['items'])
+            # The next page url already carries the offset and the limit
+            url = body.get('next')
+            params = {}
+
+        return tracks
+
+    def __track_id(self, track):
+        track_url = track['external_urls']['spotify']
+        return track_url.split('/')[-1]
 
     def __ms_to_time(self, ms):
         mins = ms // 1000 // 60
@@ -99,11 +175,9 @@ class Spotify(Getter):
         return body
 
     def __get_api_token(self):
-        token = self._find_token(self.api_tok_file)
-        if token and not self.api_token:
-            self.api_token = token
-            return
-        
+        self.api_token = self.tokens.get('api_token', self.__request_api_token)
+
+    def __request_api_token(self):
         headers = { 'Content-Type': 'application/x-www-form-urlencoded' }
         data = {
             'grant_type': 'client_credentials',
@@ -116,21 +190,15 @@ class Spotify(Getter):
 
         if not body:
             raise NoTokenException("Failed to get API token")
-        
-        self.api_token = body['access_token']
 
-        body['token'] = body.pop('access_token') 
+        body['token'] = body.pop('access_token')
         body['expires_at'] = int(time()) + body.pop('expires_in')
+        return body
 
-        with open(self.api_tok_file, 'w') as f:
-            json.dump(body, f)
-    
     def __get_lrc_token(self):
-        token = self._find_token(self.lrc_tok_file)
-        if token and not self.lrc_token:
-            self.lrc_token = token
-            return
-        
+        self.lrc_token = self.tokens.get('lrc_token', self.__request_lrc_token)
+
+    def __request_lrc_token(self):
         headers = {
             'User-Agent': self.USER_AGENT,
             'App-platform': 'WebPlayer',
@@ -141,16 +209,18 @@ class Spotify(Getter):
 
         if not body or body['isAnonymous']:
             raise NoTokenException("Failed to get LRC token")
-        
-        self.lrc_token = body['accessToken']
 
         body['token'] = body.pop('accessToken')
         body['expires_at'] = body.pop('accessTokenExpirationTimestampMs') // 1000
-        with open(self.lrc_tok_file, 'w') as f:
-            json.dump(body, f)
+        return body
+
+    def __search_isrc(self, isrc):
+        return self.__query(f'isrc:{isrc}')
 
     def __search(self, track, artist):
-        query = f'{track} artist:{artist}'
+        return self.__query(f'{track} artist:{artist}')
+
+    def __query(self, query):
         headers = { 'Authorization': f'Bearer {self.api_token}' }
         params = {
             'q': query,
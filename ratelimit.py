@@ -0,0 +1,70 @@
+import logging
+
+from threading import Lock
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+'''
+Token bucket rate limiter that adapts to the provider (AIMD)
+The rate starts at the configured maximum, is cut by DECREASE every time the provider
+answers 429 Too Many Requests, with all requests paused for the Retry-After it sent,
+and grows back linearly with every successful request
+'''
+
+class RateLimiter:
+
+    DECREASE = 0.5
+    # Fraction of the maximum rate regained with every successful request
+    INCREASE = 0.02
+    MIN_RATE = 0.5
+
+    def __init__(self, rate: float, burst: int = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    # Blocks until a request can be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+
+    # Changes the maximum rate, e.g. when the budget of a provider is split between several workers
+    def set_max_rate(self, rate: float):
+        with self.lock:
+            self.max_rate = rate
+            self.rate = min(self.rate, rate)
+            self.burst = max(1, int(rate))
+            self.tokens = min(self.tokens, self.burst)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.INCREASE)
+
+    # Throttled responses to requests that were sent before the previous throttle
+    # took effect don't lower the rate again, only one decrease happens per pause
+    def on_throttle(self, retry_after: float = None):
+        with self.lock:
+            now = monotonic()
+            if now >= self.paused_until:
+                self.rate = max(self.MIN_RATE, self.rate * self.DECREASE)
+            self.tokens = 0
+            pause = retry_after if retry_after is not None else 1 / self.rate
+            self.paused_until = max(self.paused_until, now + pause)
+        logger.debug(f"Throttled, rate lowered to {self.rate:.2f} requests/s, pausing for {pause:.1f}s")
@@ -0,0 +1,48 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Hashable
+
+'''
+Coalesces concurrent calls that share the same key, only the first caller runs the
+function while the others wait for it and receive the same result (or exception)
+When memo is given, the results of the last memo calls are also kept, so that
+repeated calls with the same key don't run the function again (exceptions are not kept)
+'''
+
+class SingleFlight:
+    def __init__(self, memo: int = 0):
+        self.lock = Lock()
+        self.calls = {}
+        self.memo = memo
+        self.results = OrderedDict()
+
+    def do(self, key: Hashable, fn: Callable):
+        with self.lock:
+            if key in self.results:
+                self.results.move_to_end(key)
+                return self.results[key]
+
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if self.memo and not call.exception():
+                    self.results[key] = call.result()
+                    if len(self.results) > self.memo:
+                        self.results.popitem(last=False)
@@ -1,39 +1,125 @@
-import music_tag
 import re
 
+# Parses the tags of the file into a plain record, which unlike the mutagen
+# handle can be sent back from a worker process
+# With keep_tags the parsed handle is kept in the record as well, so that the
+# lyrics can later be written without parsing the file a second time
+# music_tag (and mutagen with it) is only imported once a file has to be parsed, the songs
+# served from the library index never need it
+def read_tags(filepath: str, keep_tags: bool = False):
+    import music_tag
+
+    audiofile = music_tag.load_file(filepath)
+    title = audiofile['title'].value.replace("’", "'")
+
+    title = re.sub(r'\([^)]*\)', '', title).strip()
+
+    artist = audiofile['artist'].value.replace("’", "'")
+    album = audiofile['album'].value.replace("’", "'")
+    albumartist = audiofile['albumartist'].value.replace("’", "'")
+
+    album = re.sub(r"deluxe .*$", "deluxe", album, flags=re.IGNORECASE)
+    album = re.sub(r"EP", "", album, flags=re.IGNORECASE)
+
+    record = {
+        'title': title,
+        'artist': artist,
+        'album': album,
+        'albumartist': albumartist or None,
+        'duration': audiofile['#length'].value,
+        'isrc': audiofile['isrc'].value or None,
+        'has_lyrics': _has_lyrics(audiofile),
+        'filepath': filepath
+    }
+    if keep_tags:
+        record['tags'] = audiofile
+    return record
+
+# Same as read_tags, but returns a (record, error) tuple so that a single
+# unreadable file does not abort a whole scan
+def try_read_tags(filepath: str, keep_tags: bool = False):
+    from mutagen import MutagenError
+
+    try:
+        return read_tags(filepath, keep_tags), None
+    except (MutagenError, NotImplementedError, OSError, ValueError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+def _has_lyrics(audiofile):
+    if audiofile['lyrics'].value is not None and len(audiofile['lyrics'].value) > 0:
+        if not audiofile['lyrics'].value.startswith("[offset"):
+            return True
+    return False
+
 class Song:
     def __init__(self, title: str = None, artist: str = None, album: str = None, 
-                 duration: int = None, filepath: str = None):
+                 duration: int = None, filepath: str = None, isrc: str = None,
+                 albumartist: str = None):
         self.title = title
         self.artist = artist
         self.album = album
+        self.albumartist = albumartist
         self.duration = duration
+        self.isrc = isrc
         self.has_lyrics = False
+        # Provider track ids already resolved for the song (e.g. from its album), by provider name
+        self.ids = {}
+        # Outcome of the lookup of each provider in this run (hit, miss, error...), by provider name
+        self.outcomes = {}
+        # music_tag handle of the file when it was parsed in this process, reused by the writer
+        self.tags = None
         if filepath:
             self.__load_song_data(filepath)
             self.filepath = filepath
 
-    def __load_song_data(self, filepath: str):
-        audiofile = music_tag.load_file(filepath)
-        self.title = audiofile['title'].value.replace("’", "'")
+    @classmethod
+    def from_record(cls, record: dict):
+        song = cls(record['title'], record['artist'], record['album'], record['duration'],
+                   isrc=record['isrc'], albumartist=record['albumartist'])
+        song.has_lyrics = record['has_lyrics']
+        song.filepath = record['filepath']
+        song.tags = record.get('tags')
+        return song
 
-        self.title = re.sub(r'\([^)]*\)', '', self.title).strip()
+    def to_record(self):
+        return {
+            'title': self.title,
+            'artist': self.artist,
+            'album': self.album,
+            'albumartist': self.albumartist,
+            'duration': self.duration,
+            'isrc': self.isrc,
+            'has_lyrics': self.has_lyrics,
+            'filepath': self.filepath
+        }
 
-        self.artist = audiofile['artist'].value.replace("’", "'")
-        self.album = audiofile['album'].value.replace("’", "'")
-        
-        self.album = re.sub(r"deluxe .*$", "deluxe", self.album, flags=re.IGNORECASE)
-        self.album = re.sub(r"EP", "", self.album, flags=re.IGNORECASE)
-        
-        self.duration = audiofile['#length'].value
+    def __load_song_data(self, filepath: str):
+        record = read_tags(filepath, keep_tags=True)
+        self.tags = record['tags']
+        self.title = record['title']
+        self.artist = record['artist']
+        self.album = record['album']
+        self.albumartist = record['albumartist']
+        self.duration = record['duration']
+        self.isrc = record['isrc']
+        self.has_lyrics = record['has_lyrics']
 
-        self.has_lyrics = self.__check_lyrics(audiofile)
+    def __str__(self):
+        return f"Song details {{\n\ttitle: {self.title}\n\tartist: {self.artist}\n\talbum: {self.album}\n\tduration: {self.duration}\n}}"
 
-    def __check_lyrics(self, audiofile):
-        if audiofile['lyrics'].value is not None and len(audiofile['lyrics'].value) > 0:
-            if not audiofile['lyrics'].value.startswith("[offset"):
-                return True
-        return False
+    # Songs of the same album share this key, the album artist is preferred over the track artist
+    # since it stays the same across the tracks of a compilation
+    def album_key(self):
+        return (
+            ' '.join((self.album or '').casefold().split()),
+            ' '.join((self.albumartist or self.artist or '').casefold().split())
+        )
 
-    def __str__(self):
-        return f"Song details {{\n\ttitle: {self.title}\n\tartist: {self.artist}\n\talbum: {self.album}\n\tduration: {self.duration}\n}}"
\ No newline at end of file
+    # Normalized identity of the song, used to key cached provider lookups
+    # Leaving the album out and widening the duration bucket identifies the same recording
+    # across compilations and different encodings of the same track
+    def key(self, album: bool = True, duration_bucket: int = 1):
+        fields = [self.title, self.artist, self.album] if album else [self.title, self.artist]
+        fields = [' '.join((f or '').casefold().split()) for f in fields]
+        fields.append(str(round((self.duration or 0) / duration_bucket)))
+        return '\x1f'.join(fields)
@@ -0,0 +1,138 @@
+import logging
+import random
+import sqlite3
+
+from collections import Counter
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+'''
+Persistent statistics of the lookups of each provider, stored in a SQLite file
+Every lookup adds to the hits, lookups and seconds of the provider in three scopes: the whole
+library, the artist of the song and its album
+order sorts the providers of a song by their expected seconds per hit (mean latency divided
+by the probability of a hit), which minimizes the expected time to the first hit when they
+are queried one after the other
+The estimates of a scope start from the ones of the wider scope, weighted as PRIOR_WEIGHT
+lookups, so that an album seen twice does not override what is known about its artist
+With probability explore a song is looked up in a random order instead, so that the providers
+that fell behind keep being measured
+The counts are written in batches and added to the ones in the file, so that several
+workers can share it
+'''
+
+class ProviderStats:
+
+    EXPLORE = 0.05
+    PRIOR_WEIGHT = 5
+    # Assumed before any lookup of the provider was timed
+    PRIOR_HIT_RATE = 0.5
+    PRIOR_LATENCY = 1
+    FLUSH_EVERY = 100
+
+    def __init__(self, path: str, explore: float = None, seed: int = None):
+        self.explore = explore if explore is not None else self.EXPLORE
+        self.rng = random.Random(seed)
+        self.lock = Lock()
+        # [hits, lookups, seconds] by scope, then by provider: what the file had plus the lookups of this run
+        self.counts = {}
+        # Lookups of this run that are not in the file yet, same layout
+        self.pending = {}
+        self.recorded = 0
+        # Number of songs each provider was put first for
+        self.leaders = Counter()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS stats (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                provider TEXT NOT NULL,
+                hits INTEGER NOT NULL,
+                lookups INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                PRIMARY KEY (scope, key, provider)
+            )''')
+
+    # Returns the providers sorted by expected seconds per hit for the song, ties keep the given order
+    def order(self, song, providers: list):
+        if len(providers) < 2:
+            return providers
+
+        if self.rng.random() < self.explore:
+            order = self.rng.sample(providers, len(providers))
+        else:
+            with self.lock:
+                levels = [self.__load(scope) for scope in scopes(song)]
+            costs = {prov: self.__cost(prov, levels) for prov in providers}
+            order = sorted(providers, key=costs.get)
+
+        self.leaders[order[0]] += 1
+        return order
+
+    def __cost(self, provider: str, levels: list):
+        hit_rate = self.PRIOR_HIT_RATE
+        latency = self.PRIOR_LATENCY
+        for counts in levels:
+            hits, lookups, seconds = counts.get(provider, (0, 0, 0))
+            hit_rate = (hits + self.PRIOR_WEIGHT * hit_rate) / (lookups + self.PRIOR_WEIGHT)
+            latency = (seconds + self.PRIOR_WEIGHT * latency) / (lookups + self.PRIOR_WEIGHT)
+        return latency / hit_rate
+
+    def record(self, provider: str, song, hit: bool, seconds: float):
+        with self.lock:
+            for scope in scopes(song):
+                for counts in (self.__load(scope), self.pending.setdefault(scope, {})):
+                    entry = counts.setdefault(provider, [0, 0, 0])
+                    entry[0] += hit
+                    entry[1] += 1
+                    entry[2] += seconds
+
+            self.recorded += 1
+            if self.recorded % self.FLUSH_EVERY == 0:
+                self.__flush()
+
+    # Reads the counts of the scope from the file the first time it is needed
+    def __load(self, scope: tuple):
+        counts = self.counts.get(scope)
+        if counts is None:
+            counts = self.counts[scope] = {
+                provider: [hits, lookups, seconds] for provider, hits, lookups, seconds in self.db.execute(
+                    'SELECT provider, hits, lookups, seconds FROM stats WHERE scope = ? AND key = ?', scope)
+            }
+        return counts
+
+    # The statistics only steer the order, so a file held by another worker for too long
+    # only delays the write to the next flush
+    def __flush(self):
+        rows = [
+            (*scope, provider, hits, lookups, seconds)
+            for scope, counts in self.pending.items()
+            for provider, (hits, lookups, seconds) in counts.items()
+        ]
+        if not rows:
+            return
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.executemany(
+                'INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (scope, key, provider) DO UPDATE SET '
+                'hits = hits + excluded.hits, lookups = lookups + excluded.lookups, seconds = seconds + excluded.seconds',
+                rows)
+            self.db.execute('COMMIT')
+        except sqlite3.OperationalError as e:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            logger.debug(f"Failed to save the provider statistics, retrying later: {e}")
+            return
+        self.pending = {}
+
+    def close(self):
+        with self.lock:
+            self.__flush()
+            self.db.close()
+
+def scopes(song):
+    artist = (song.albumartist or song.artist or '').lower()
+    return [('global', ''), ('artist', artist), ('album', f"{artist}\0{(song.album or '').lower()}")]
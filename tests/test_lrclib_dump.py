@@ -0,0 +1,67 @@
+import sqlite3
+
+import pytest
+
+from providers.lrclib_dump import LrclibDump, build_index
+from song import Song
+
+# (name, artist, album, duration, synced lyrics, plain lyrics)
+TRACKS = [
+    ('Exact Song', 'Some Artist', 'Some Album', 200, '[00:01.00] exact synced', 'exact plain'),
+    ('Hello World (Remastered)', 'Band', 'Greatest Hits', 180, '[00:01.00] hello synced', 'hello plain'),
+    ('Plain Only', 'Some Artist', 'Some Album', 150, None, 'only plain')
+]
+
+# Same layout as the tables of the LRCLIB dumps that the provider reads
+@pytest.fixture
+def dump(tmp_path):
+    path = str(tmp_path / 'lrclib.sqlite3')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE lyrics (id INTEGER PRIMARY KEY, synced_lyrics TEXT, plain_lyrics TEXT)')
+    db.execute('''
+        CREATE TABLE tracks (
+            id INTEGER PRIMARY KEY, name TEXT, name_lower TEXT, artist_name TEXT, artist_name_lower TEXT,
+            album_name TEXT, album_name_lower TEXT, duration REAL, last_lyrics_id INTEGER
+        )''')
+    for n, (name, artist, album, duration, synced, plain) in enumerate(TRACKS, 1):
+        db.execute('INSERT INTO lyrics VALUES (?, ?, ?)', (n, synced, plain))
+        db.execute('INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                   (n, name, name.lower(), artist, artist.lower(), album, album.lower(), duration, n))
+    db.commit()
+    db.close()
+    build_index(path)
+    return path
+
+def test_exact_match(dump):
+    provider = LrclibDump(dump)
+    song = Song('Exact Song', 'Some Artist', 'Some Album', 200)
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] exact synced'
+
+def test_full_text_fallback(dump):
+    provider = LrclibDump(dump)
+    song = Song('Hello World', 'Band', 'Greatest Hits', 180)
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello synced'
+
+def test_miss(dump):
+    provider = LrclibDump(dump)
+    song = Song('Unknown Song', 'Nobody', 'Nothing', 100)
+    assert provider.get_lyrics(song, 'synced') is None
+
+def test_synced_and_plain(dump):
+    provider = LrclibDump(dump)
+    song = Song('Exact Song', 'Some Artist', 'Some Album', 200)
+    assert provider.get_lyrics(song, 'plain') == 'exact plain'
+
+    plain_only = Song('Plain Only', 'Some Artist', 'Some Album', 150)
+    assert provider.get_lyrics(plain_only, 'synced') is None
+    assert provider.get_lyrics(plain_only, 'plain') == 'only plain'
+
+def test_without_full_text_index(dump):
+    db = sqlite3.connect(dump)
+    db.execute('DROP TABLE tracks_fts')
+    db.commit()
+    db.close()
+
+    provider = LrclibDump(dump)
+    assert provider.get_lyrics(Song('Hello World', 'Band', 'Greatest Hits', 180), 'synced') is None
+    assert provider.get_lyrics(Song('Exact Song', 'Some Artist', 'Some Album', 200), 'synced') == '[00:01.00] exact synced'
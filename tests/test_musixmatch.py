@@ -0,0 +1,113 @@
+import json
+import os
+
+import pytest
+
+from providers.musixmatch import Musixmatch
+from song import Song
+from tokens import TokenBroker
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'musixmatch')
+
+def fixture(name: str):
+    with open(os.path.join(FIXTURES, f"{name}.json")) as f:
+        return json.load(f)
+
+class Response:
+    def __init__(self, status_code: int, body):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.body = body
+        self.headers = {}
+        self.url = ''
+
+    def json(self):
+        return self.body
+
+# Replays recorded responses by endpoint (the last one is repeated) and keeps the requests
+class Session:
+    def __init__(self, responses: dict):
+        self.responses = {endpoint: list(replies) for endpoint, replies in responses.items()}
+        self.requests = []
+
+    def request(self, method, url, params=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.requests.append((endpoint, params or {}))
+        replies = self.responses[endpoint]
+        status, name = replies.pop(0) if len(replies) > 1 else replies[0]
+        return Response(status, fixture(name) if name else {})
+
+    def close(self):
+        pass
+
+    def endpoints(self):
+        return [endpoint for endpoint, _ in self.requests]
+
+def musixmatch(tmp_path, responses: dict):
+    responses = {'token.get': [(200, 'token_get')], **responses}
+    provider = Musixmatch(str(tmp_path), tokens=TokenBroker(str(tmp_path)), rate=0, retries=0)
+    provider.session = Session(responses)
+    return provider
+
+FALLBACK = {
+    'track.search': [(200, 'track_search')],
+    'track.subtitle.get': [(200, 'track_subtitle_get')]
+}
+
+@pytest.fixture
+def song():
+    return Song('Hello', 'Artist', 'Album', 200)
+
+def test_macro_hit(tmp_path, song):
+    provider = musixmatch(tmp_path, {'macro.subtitles.get': [(200, 'macro_hit')]})
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello synced'
+    assert provider.get_lyrics(song, 'plain') == 'hello plain'
+    assert provider.session.endpoints() == ['token.get', 'macro.subtitles.get', 'macro.subtitles.get']
+
+def test_macro_matcher_miss(tmp_path, song):
+    provider = musixmatch(tmp_path, {'macro.subtitles.get': [(200, 'macro_matcher_404')], **FALLBACK})
+    assert provider.get_lyrics(song, 'synced') is None
+    assert provider.macro_available
+    assert 'track.search' not in provider.session.endpoints()
+
+def test_macro_instrumental(tmp_path, song):
+    provider = musixmatch(tmp_path, {'macro.subtitles.get': [(200, 'macro_instrumental')]})
+    assert provider.get_lyrics(song, 'synced') is None
+
+def test_rejected_token_is_renewed(tmp_path, song):
+    provider = musixmatch(tmp_path, {
+        'token.get': [(200, 'token_get'), (200, 'token_get_renewed')],
+        'macro.subtitles.get': [(200, 'macro_renew_token'), (200, 'macro_hit')]
+    })
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello synced'
+    assert provider.macro_available
+
+    macro_tokens = [params['usertoken'] for endpoint, params in provider.session.requests if endpoint == 'macro.subtitles.get']
+    assert macro_tokens == ['token-1', 'token-2']
+
+# A failed macro call only sends its song through the search and subtitle calls
+def test_macro_failure_falls_back_for_the_song(tmp_path, song):
+    provider = musixmatch(tmp_path, {
+        'macro.subtitles.get': [(200, 'macro_unavailable'), (200, 'macro_hit')],
+        **FALLBACK
+    })
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello from subtitle'
+    assert provider.macro_available
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello synced'
+    assert provider.session.endpoints() == [
+        'token.get', 'macro.subtitles.get', 'track.search', 'track.subtitle.get', 'macro.subtitles.get'
+    ]
+
+# An endpoint that does not exist turns the macro call off for the rest of the run
+def test_missing_macro_endpoint_is_disabled(tmp_path, song):
+    provider = musixmatch(tmp_path, {'macro.subtitles.get': [(404, None)], **FALLBACK})
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello from subtitle'
+    assert not provider.macro_available
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello from subtitle'
+    assert provider.session.endpoints().count('macro.subtitles.get') == 1
+
+def test_search_and_subtitle_calls(tmp_path, song):
+    provider = musixmatch(tmp_path, FALLBACK)
+    provider.macro_available = False
+    assert provider.get_lyrics(song, 'synced') == '[00:01.00] hello from subtitle'
+    assert provider.session.endpoints() == ['token.get', 'track.search', 'track.subtitle.get']
@@ -0,0 +1,113 @@
+import json
+import logging
+import os
+
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+from typing import Callable
+
+from metrics import metrics
+from singleflight import SingleFlight
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+'''
+Shared store of the provider tokens
+Tokens are kept in memory and refreshed refresh_margin seconds before they expire,
+concurrent refreshes of the same token are coalesced into a single request, and the
+token files are locked so that several processes on the same host share one token
+instead of each requesting its own (the file lock is skipped where fcntl is not available)
+'''
+
+class TokenBroker:
+
+    REFRESH_MARGIN = 60
+
+    def __init__(self, token_dir: str, refresh_margin: int = None):
+        self.token_dir = token_dir
+        self.refresh_margin = refresh_margin if refresh_margin is not None else self.REFRESH_MARGIN
+        self.tokens = {}
+        self.lock = Lock()
+        self.flights = SingleFlight()
+
+        if not os.path.exists(token_dir):
+            os.makedirs(token_dir)
+
+    # Returns the token with the given name, calling fetch to request a new one when there
+    # is no fresh token in memory or on disk, fetch returns a dict with 'token' and 'expires_at'
+    # and raises NoTokenException when the token can't be obtained
+    def get(self, name: str, fetch: Callable[[], dict]):
+        token = self.__fresh(self.tokens.get(name))
+        if token:
+            return token
+        return self.flights.do(name, lambda: self.__refresh(name, fetch))
+
+    def __refresh(self, name: str, fetch: Callable[[], dict]):
+        path = os.path.join(self.token_dir, f"{name}.json")
+
+        with self.__file_lock(name):
+            tok = self.__read(path)
+            if not self.__fresh(tok):
+                logger.debug(f"Requesting a new {name}")
+                with metrics.timer('stage', stage='token', token=name):
+                    tok = fetch()
+                self.__write(path, tok)
+
+        with self.lock:
+            self.tokens[name] = tok
+        return tok['token']
+
+    # Drops a token that the provider rejected, so that the next get requests a new one,
+    # unless another thread or process already replaced it
+    def invalidate(self, name: str, token: str):
+        path = os.path.join(self.token_dir, f"{name}.json")
+
+        with self.__file_lock(name):
+            with self.lock:
+                if self.tokens.get(name, {}).get('token') == token:
+                    del self.tokens[name]
+            tok = self.__read(path)
+            if tok and tok.get('token') == token:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        logger.debug(f"Dropped the rejected {name}")
+
+    def __fresh(self, tok: dict):
+        if not tok or int(time()) + self.refresh_margin > tok.get('expires_at', 0):
+            return None
+        return tok.get('token', None)
+
+    def __read(self, path: str):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # Written through a temporary file, so that other processes never read a partial token
+    def __write(self, path: str, tok: dict):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(tok, f)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def __file_lock(self, name: str):
+        if not fcntl:
+            yield
+            return
+
+        with open(os.path.join(self.token_dir, f"{name}.lock"), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
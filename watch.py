@@ -0,0 +1,216 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+'''
+Watchers of a library folder, yielding batches of the audio files added or modified under it
+InotifyWatcher subscribes to the kernel events of every folder of the tree (Linux only, through
+ctypes), PollingWatcher compares the size and modification time of the files every interval
+seconds instead, for network filesystems where inotify sees no remote changes
+Events are debounced: a batch is only yielded once no file changed for debounce seconds,
+so that the songs of an album being copied are handed over together, or max_delay seconds
+after its first change during very long copies
+'''
+
+class Watcher:
+
+    DEBOUNCE = 2
+    MAX_DELAY = 30
+
+    def __init__(self, root: str, extensions: tuple, debounce: float = None, max_delay: float = None):
+        self.root = root
+        self.extensions = extensions
+        self.debounce = debounce if debounce is not None else self.DEBOUNCE
+        self.max_delay = max_delay if max_delay is not None else self.MAX_DELAY
+
+    # Returns the paths that changed within timeout seconds (None waits for the next change)
+    def _changes(self, timeout: float):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _is_audio(self, path: str):
+        return path.endswith(self.extensions)
+
+    def _walk(self, directory: str):
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._walk(entry.path)
+                    elif entry.is_file() and self._is_audio(entry.name):
+                        yield entry
+        except OSError as e:
+            logger.warning(f"Failed to scan {directory}: {e}")
+
+    def __iter__(self):
+        pending = set()
+        first = last = 0
+        while True:
+            timeout = None
+            if pending:
+                timeout = max(0, min(last + self.debounce, first + self.max_delay) - monotonic())
+
+            changes = self._changes(timeout)
+            now = monotonic()
+            if changes:
+                if not pending:
+                    first = now
+                last = now
+                pending.update(changes)
+
+            if pending and (now - last >= self.debounce or now - first >= self.max_delay):
+                # Sorted, so that the songs of an album follow each other
+                yield sorted(pending)
+                pending = set()
+
+class InotifyWatcher(Watcher):
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, root: str, extensions: tuple, debounce: float = None, max_delay: float = None):
+        super().__init__(root, extensions, debounce, max_delay)
+        self.libc = load_libc()
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        # Watched folder by watch descriptor
+        self.dirs = {}
+        self.__watch_tree(root)
+        logger.debug(f"Watching {len(self.dirs)} folders under {root}")
+
+    # Also returns the audio files already in the folders, which were created before their watch
+    def __watch_tree(self, directory: str):
+        found = []
+        self.__watch(directory)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        found.extend(self.__watch_tree(entry.path))
+                    elif entry.is_file() and self._is_audio(entry.name):
+                        found.append(entry.path)
+        except OSError as e:
+            logger.warning(f"Failed to scan {directory}: {e}")
+        return found
+
+    def __watch(self, directory: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK | self.IN_ONLYDIR)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                logger.warning(f"Out of inotify watches, {directory} is not watched "
+                               f"(raise fs.inotify.max_user_watches or use --poll)")
+            else:
+                logger.warning(f"Failed to watch {directory}: {os.strerror(error)}")
+            return
+        self.dirs[wd] = directory
+
+    def _changes(self, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                logger.warning('Missed some filesystem events, rescanning the library')
+                changes.extend(entry.path for entry in self._walk(self.root))
+                continue
+            if mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                # A folder created or moved into the library (e.g. a new album)
+                changes.extend(self.__watch_tree(path))
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and self._is_audio(name):
+                changes.append(path)
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher(Watcher):
+
+    INTERVAL = 30
+
+    def __init__(self, root: str, extensions: tuple, interval: float = None,
+                 debounce: float = None, max_delay: float = None):
+        super().__init__(root, extensions, debounce, max_delay)
+        self.interval = interval or self.INTERVAL
+        self.snapshot = self.__scan()
+        # Files that changed in the last scan, only reported once a scan finds them unchanged,
+        # since a file that is still being copied changes from one scan to the next
+        self.settling = set()
+        self.next_scan = monotonic() + self.interval
+
+    def __scan(self):
+        snapshot = {}
+        for entry in self._walk(self.root):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _changes(self, timeout: float):
+        wait = self.next_scan - monotonic()
+        if timeout is not None and timeout < wait:
+            sleep(timeout)
+            return []
+        sleep(max(0, wait))
+
+        snapshot = self.__scan()
+        self.next_scan = monotonic() + self.interval
+        changed = {path for path, stat in snapshot.items() if self.snapshot.get(path) != stat}
+        settled = [path for path in self.settling if path in snapshot and path not in changed]
+        self.snapshot = snapshot
+        self.settling = changed
+        return settled
+
+def load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not available')
+    return libc
+
+def inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        load_libc()
+    except OSError:
+        return False
+    return True
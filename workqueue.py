@@ -0,0 +1,174 @@
+import logging
+import os
+import socket
+import sqlite3
+
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+from time import time
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+'''
+Queue of songs shared by several worker processes, on one host or on several hosts
+that reach the same storage, stored in a SQLite file next to the library
+A coordinator enqueues the paths of the songs, workers lease a few songs at a time and
+record their outcome, while a heartbeat extends the leases of the songs they are working
+on; the songs of a worker that crashed are leased again by the others once its leases
+expire, up to MAX_ATTEMPTS times
+The heartbeats also tell each worker how many workers are active, so that they can split
+the rate budget of each provider between them
+The file uses the rollback journal rather than WAL, which needs memory shared between the
+processes and does not work on network filesystems
+'''
+
+class WorkQueue:
+
+    LEASE = 120
+    HEARTBEAT = 30
+    MAX_ATTEMPTS = 3
+    # Outcomes of the songs that did not get lyrics because something failed
+    ERRORS = ('error', 'failed', 'unreadable')
+
+    def __init__(self, path: str, lease: float = None):
+        self.lease_duration = lease or self.LEASE
+        self.lock = Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=60)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                path TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                outcome TEXT,
+                updated_at REAL NOT NULL
+            )''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, path)')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                heartbeat REAL NOT NULL
+            )''')
+
+    # Adds the songs that are not in the queue yet and queues the ones that failed again,
+    # returns how many songs were queued
+    def enqueue(self, paths: Iterable, batch: int = 1000):
+        queued = 0
+        rows = []
+        for path in paths:
+            rows.append((os.path.abspath(path), time()))
+            if len(rows) >= batch:
+                queued += self.__insert(rows)
+                rows = []
+        if rows:
+            queued += self.__insert(rows)
+        return queued
+
+    def __insert(self, rows: list):
+        with self.__transaction():
+            before = self.db.total_changes
+            self.db.executemany(
+                "INSERT INTO jobs (path, state, updated_at) VALUES (?, 'queued', ?) "
+                "ON CONFLICT (path) DO UPDATE SET state = 'queued', attempts = 0, updated_at = excluded.updated_at "
+                "WHERE state = 'error'", rows)
+            return self.db.total_changes - before
+
+    # Takes the write lock of the file right away, so that two workers never lease the same songs
+    @contextmanager
+    def __transaction(self):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    # Leases up to count songs to the worker, the queued ones and the ones whose lease expired
+    def lease(self, worker: str, count: int):
+        now = time()
+        with self.__transaction():
+            # Songs that keep taking their workers down are given up on
+            self.db.execute(
+                "UPDATE jobs SET state = 'error', outcome = 'abandoned', updated_at = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.MAX_ATTEMPTS))
+            paths = [row[0] for row in self.db.execute(
+                "SELECT path FROM jobs WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY path LIMIT ?", (now, count))]
+            self.db.executemany(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE path = ?", [(worker, now + self.lease_duration, now, path) for path in paths])
+        return paths
+
+    def complete(self, path: str, outcome: str):
+        state = 'error' if outcome in self.ERRORS else 'done'
+        with self.lock:
+            self.db.execute(
+                'UPDATE jobs SET state = ?, outcome = ?, lease_until = NULL, updated_at = ? WHERE path = ?',
+                (state, outcome, time(), path))
+
+    # Extends the leases of the worker, returns the number of active workers (itself included)
+    def heartbeat(self, worker: str):
+        now = time()
+        with self.__transaction():
+            self.db.execute('INSERT OR REPLACE INTO workers VALUES (?, ?)', (worker, now))
+            self.db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = 'leased'",
+                (now + self.lease_duration, worker))
+            self.db.execute('DELETE FROM workers WHERE heartbeat < ?', (now - self.lease_duration,))
+            return self.db.execute('SELECT COUNT(*) FROM workers').fetchone()[0]
+
+    def leave(self, worker: str):
+        with self.lock:
+            self.db.execute('DELETE FROM workers WHERE id = ?', (worker,))
+
+    # Number of songs that are queued or leased, by any worker
+    def remaining(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')").fetchone()[0]
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# Keeps the leases of a worker alive and reports the number of active workers to on_workers
+class Heartbeat:
+
+    def __init__(self, queue: WorkQueue, worker: str, on_workers: Callable[[int], None] = None):
+        self.queue = queue
+        self.worker = worker
+        self.on_workers = on_workers
+        self.stopped = Event()
+        self.beat()
+        self.thread = Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def beat(self):
+        try:
+            workers = self.queue.heartbeat(self.worker)
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to renew the leases of {self.worker}: {e}")
+            return
+        if self.on_workers:
+            self.on_workers(workers)
+
+    def __run(self):
+        while not self.stopped.wait(min(self.queue.HEARTBEAT, self.queue.lease_duration / 3)):
+            self.beat()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.queue.leave(self.worker)
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
@@ -0,0 +1,131 @@
+import logging
+import os
+import shutil
+
+from concurrent.futures import Future
+from queue import Queue
+from threading import Thread
+from typing import Callable
+
+from metrics import metrics
+from song import Song
+
+logger = logging.getLogger(__name__)
+
+'''
+Writer stage of the pipeline, persisting the lyrics on its own pool of worker threads
+so that slow disks don't stall the network fetches
+Writes go through a temporary file in the same directory that is then renamed over the
+original, so a crash can never leave a truncated audio or .lrc file behind
+Symlinks are resolved first, so that the target gets the lyrics and the link stays a link
+The copy keeps the permissions and owner of the original, hard links are written in place
+'''
+
+class LyricsWriter:
+
+    # on_saved is called with the song once its lyrics are embedded in the file
+    def __init__(self, workers: int, dump: bool = False, on_saved: Callable[[Song], None] = None):
+        self.dump = dump
+        self.on_saved = on_saved
+        # Bounded, so that fetches wait for the disk instead of piling lyrics up in memory
+        self.queue = Queue(maxsize=workers * 4)
+        self.workers = [Thread(target=self.__work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    # Queues the lyrics for writing, the future resolves to an (ok, reason) tuple
+    def submit(self, song: Song, lyrics: str):
+        future = Future()
+        self.queue.put((song, f"[00:00.00] {song.title}\n{lyrics}", future))
+        return future
+
+    # Waits for the queued writes to complete and stops the workers
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def __work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            song, lyrics, future = item
+            try:
+                with metrics.timer('stage', stage='write'):
+                    if self.dump:
+                        self.__dump_lyrics(song, lyrics)
+                    else:
+                        self.__edit_song_lyrics(song, lyrics)
+            except Exception as e:
+                logger.debug(f"Failed to save lyrics of {song.filepath}", exc_info=True)
+                metrics.count('writes', result='failed')
+                future.set_result((False, f"{type(e).__name__}: {e}"))
+                continue
+            metrics.count('writes', result='ok')
+            future.set_result((True, None))
+
+    def __dump_lyrics(self, song: Song, lyrics: str):
+        filename = os.path.realpath(os.path.splitext(song.filepath)[0] + '.lrc')
+        tmp = self.__tmp_path(filename)
+        try:
+            with open(tmp, 'w') as f:
+                f.write(lyrics)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, filename)
+        finally:
+            self.__discard(tmp)
+
+    # Reuses the tags parsed while loading the song when they are still around,
+    # music_tag saves them into a copy of the file, which then replaces the original
+    # A file with several hard links is saved in place instead, replacing it would
+    # leave the other links pointing at the old file
+    def __edit_song_lyrics(self, song: Song, lyrics: str):
+        import music_tag
+
+        song_file = song.tags or music_tag.load_file(song.filepath)
+        song_file['lyrics'] = lyrics
+
+        filepath = os.path.realpath(song.filepath)
+        if os.stat(filepath).st_nlink > 1:
+            song_file.save()
+        else:
+            tmp = self.__tmp_path(filepath)
+            try:
+                song_file.save(tmp)
+                self.__copy_attributes(filepath, tmp)
+                with open(tmp, 'rb') as f:
+                    os.fsync(f.fileno())
+                os.replace(tmp, filepath)
+            finally:
+                self.__discard(tmp)
+        song.tags = None
+
+        if self.on_saved:
+            self.on_saved(song)
+
+    # Gives the copy the permissions, flags and owner of the original, but a new modification
+    # time, since its content did change
+    # Only root can give a file away, other users keep the copy as their own
+    def __copy_attributes(self, path: str, tmp: str):
+        stat = os.stat(path)
+        shutil.copystat(path, tmp)
+        os.utime(tmp)
+        if hasattr(os, 'chown') and (stat.st_uid, stat.st_gid) != (os.getuid(), os.getgid()):
+            try:
+                os.chown(tmp, stat.st_uid, stat.st_gid)
+            except PermissionError:
+                logger.debug(f"Could not keep the owner of {path}, it now belongs to the user running the script")
+
+    def __tmp_path(self, path: str):
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+
+    def __discard(self, tmp: str):
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass